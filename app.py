@@ -1,13 +1,19 @@
+import json
 import logging
 from unittest.mock import DEFAULT
 import os
 
-from flask import Flask, render_template, jsonify, request, send_from_directory
+from flask import Flask, Response, g, render_template, jsonify, request, send_from_directory, stream_template
 
-import python.firebase_api as db
+import python.storage as storage
 import python.strava_api as strava
 from python.timestamps import epoch_timestamp_now
 import python.matching as matching
+import python.parallel_matching as parallel_matching
+import python.pipeline as pipeline
+import python.metrics as metrics
+from python.graph_registry import get_graph, default_registry
+from python.map_boundary import load_map_boundary
 from python.file_util import *
 
 from dotenv import load_dotenv
@@ -18,9 +24,41 @@ load_dotenv() # Take environment variables from .env.
 
 app = Flask(__name__)
 logger = app.logger
+db = storage.load_backend() # Picked by STORAGE_BACKEND (see python/storage.py).
 STRAVA_TOKEN = strava.get_token_always_valid()
 DEFAULT_USER_ID = str(os.getenv('DEFAULT_USER_ID'))
 
+#===============================================================================
+
+@app.before_request
+def start_timings():
+  """
+  Collect a breakdown of the time spent in each stage (see python/metrics.py) while handling a request.
+  """
+  g.timings = metrics.start_timings()
+
+
+@app.after_request
+def add_timings(response):
+  """
+  Send the request's timing breakdown back in a Server-Timing header, and in
+  the JSON body of actions that return an object.
+  """
+  metrics.stop_timings()
+  timings = metrics.timings_ms(g.pop('timings', {}))
+
+  if timings:
+    response.headers['Server-Timing'] = ', '.join(
+        '{};dur={}'.format(stage.replace('.', '-'), ms) for stage, ms in timings.items())
+
+  if request.path.startswith('/action/') and response.is_json:
+    body = response.get_json()
+    if isinstance(body, dict):
+      body['timings_ms'] = timings
+      response.set_data(json.dumps(body))
+
+  return response
+
 #===============================================================================
 #============================= SERVER ROUTES ===================================
 #===============================================================================
@@ -31,7 +69,10 @@ def render_map():
   """
   Render the MapBox map visualization. This is the default page.
   """
-  return render_template("map.html")
+  map_id = 'CAMBRIDGE_MA_US'
+  # The page only draws coverage that was saved for the same edge order as the street layer.
+  return render_template("map.html", storage_backend=storage.backend_name(), map_id=map_id,
+                         edge_order_version=get_graph(map_id).edge_order_version)
 
 #===============================================================================
 
@@ -40,14 +81,7 @@ def render_activities():
   """
   Show the activities page.
   """
-  try:
-    d = db.get_activity_data(DEFAULT_USER_ID)
-
-  except Exception as e:
-    logger.exception(e)
-    return jsonify({'error': str(e)}), 300
-
-  return render_template("activities.html", activity_data=[] if d is None else d.values())
+  return render_activity_list("activities.html")
 
 #===============================================================================
 
@@ -66,14 +100,40 @@ def render_admin():
   """
   Show the activities page.
   """
+  return render_activity_list("admin.html")
+
+
+# The most activities that can be listed on one page.
+MAX_ACTIVITY_PAGE = 500
+
+
+def render_activity_list(template):
+  """
+  Stream a page that lists one page of the user's activities, newest first
+  (see templates/activity_list.html). The 'before' query parameter is the
+  cursor of the page to show (the newest page if it's missing), and 'limit'
+  is the number of activities per page.
+
+  Only that page's metadata is read, so the page takes the same time however
+  many activities the user has. It's read before anything is sent, so that a
+  failed read is reported as an error.
+  """
   try:
-    d = db.get_activity_data(DEFAULT_USER_ID)
+    limit = min(max(int(request.args.get('limit', 50)), 1), MAX_ACTIVITY_PAGE)
+    page = storage.ActivityPage(db, DEFAULT_USER_ID, cursor=request.args.get('before'), limit=limit)
+  except ValueError as e:
+    return jsonify({'error': str(e)}), 400
+
+  try:
+    stats = db.get_user_stats(DEFAULT_USER_ID)
+    page.fetch()
 
   except Exception as e:
     logger.exception(e)
     return jsonify({'error': str(e)}), 300
 
-  return render_template("admin.html", activity_data=[] if d is None else d.values())
+  return stream_template(template, activities=page, total_activities=stats.get('total_activities', 0),
+                         first_page='before' not in request.args)
 
 
 @app.route('/about')
@@ -128,12 +188,15 @@ def update_activities():
 
     new_count = len(new_ids)
 
+    # Get activity data from Strava and add (the relevant part) to our database, a batch at a time.
+    batch = []
     for i, activity_id in enumerate(new_ids):
       logger.debug('processing #{}/{} (id={})'.format(i+1, len(new_ids), activity_id))
-
-      # Get activity data from Strava and add (the relevant part) to our database.
-      activity_data = strava.get_activity_by_id(STRAVA_TOKEN, activity_id)
-      db.add_or_update_activity(DEFAULT_USER_ID, activity_id, activity_data)
+      batch.append((activity_id, strava.get_activity_by_id(STRAVA_TOKEN, activity_id)))
+      if len(batch) == 50:
+        db.add_or_update_activities(DEFAULT_USER_ID, batch)
+        batch = []
+    db.add_or_update_activities(DEFAULT_USER_ID, batch)
 
     return jsonify({'total_count': len(maybe_new_ids), 'new_count': new_count}), 200
 
@@ -146,10 +209,11 @@ def update_activities():
 @app.route('/action/compute-stats')
 def compute_stats():
   """
-  Recompute stats over the database.
+  Recompute stats over the whole database. Stats are kept up to date as
+  activities and coverage are added, so this is only needed to repair them.
   """
   try:
-    r = db.update_user_stats(DEFAULT_USER_ID)
+    r = db.recompute_user_stats(DEFAULT_USER_ID)
     return jsonify(r), 200
 
   except Exception as e:
@@ -158,10 +222,51 @@ def compute_stats():
 
 #===============================================================================
 
+@app.route('/action/migrate-activities')
+def migrate_activities():
+  """
+  Convert activities that were saved with decoded coordinates to encoded polylines, and add
+  activities saved before the start_date index to it (see get_activity_page).
+  """
+  try:
+    migrated = db.migrate_activity_geometry(DEFAULT_USER_ID)
+    return jsonify({'migrated': migrated}), 200
+
+  except Exception as e:
+    logger.exception(e)
+    return jsonify({'error': str(e)}), 300
+
+#===============================================================================
+
+@app.route('/action/migrate-coverage/<map_id>')
+def migrate_coverage(map_id):
+  """
+  Convert coverage that was saved as a copy of every completed edge to a bitset.
+  """
+  try:
+    migrated = db.migrate_coverage(DEFAULT_USER_ID, map_id)
+    return jsonify({'migrated': migrated}), 200
+
+  except Exception as e:
+    logger.exception(e)
+    return jsonify({'error': str(e)}), 300
+
+#===============================================================================
+
 @app.route('/action/match-activities/<map_id>')
 def match_activities(map_id):
   """
   Match GPS points from activities with edges in the road network.
+
+  The 'workers' arg sets how many processes to match with (defaults to the
+  MATCH_WORKERS environment variable, or 1). The 'method' arg picks the matcher:
+  'nodes' (default) or 'segments' (see matching.match_activities_by_segments).
+
+  Activities are read, matched and written as a pipeline (see
+  pipeline.match_and_write). The 'prefetch' arg sets how many activities are
+  read ahead of matching (defaults to MATCH_PREFETCH, or 32) and 'write_queue'
+  how many matched activities can wait to be written (defaults to
+  MATCH_WRITE_QUEUE, or 64). Setting both to 0 runs every step one at a time.
   """
   try:
     if map_id not in ['CAMBRIDGE_MA_US']:
@@ -170,6 +275,11 @@ def match_activities(map_id):
     # If unspecified, just process new activities (fast option).
     scope = request.args.get('scope', 'new_only', type=str)
     assert(scope in ['all', 'new_only'])
+    workers = request.args.get('workers', parallel_matching.default_workers(), type=int)
+    method = request.args.get('method', 'nodes', type=str)
+    assert(method in matching.MATCHERS)
+    prefetch_depth = request.args.get('prefetch', pipeline.default_prefetch(), type=int)
+    write_queue = request.args.get('write_queue', pipeline.default_write_queue(), type=int)
 
     activity_ids = db.get_activity_ids(DEFAULT_USER_ID)
     matched_ids = db.get_processed_activity_ids_for_map(DEFAULT_USER_ID, map_id)
@@ -182,38 +292,32 @@ def match_activities(map_id):
 
     logger.info('Matching {} new activity ids (scope is {})'.format(len(unmatched_ids), scope))
 
-    nodes_df, edges_df = matching.load_graph(graph_data_folder('{}.gpkg'.format(map_id)))
-    logger.debug('Loaded graph')
+    # The graph and its KDtree stay loaded between requests.
+    with metrics.span('graph.get'):
+      graph = get_graph(map_id)
 
-    # Build a KDtree for fast queries.
-    kdtree = matching.kdtree_from_gdf(nodes_df)
-    logger.debug('Built kdtree')
+    unmatched_ids = list(unmatched_ids)
 
-    for activity_id in unmatched_ids:
-      logger.debug('Processing {}'.format(activity_id))
+    def fetch(activity_id):
+      logger.debug('Fetching {}'.format(activity_id))
+      return storage.activity_coordinates(db.get_activity_by_id(DEFAULT_USER_ID, activity_id))
 
-      activity_data = db.get_activity_by_id(DEFAULT_USER_ID, activity_id)
-      query_points = matching.resample_points(activity_data['geometry']['coordinates'], spacing=15.0)
-      matched_edges = matching.match_points_to_edges(query_points, nodes_df, edges_df, kdtree, max_node_dist=30)
+    # Match (optionally on several processes) while the next activities are read and the last ones written.
+    graph_file = graph_data_folder('{}.gpkg'.format(map_id))
+    params = {'spacing': 15.0, 'max_node_dist': 30} if method == 'nodes' else {}
 
-      matched_ids = []
-      edge_geometries = []
-      edge_lengths = []
-      for i in range(len(matched_edges)):
-        from_id = str(matched_edges.iloc[i]['from'])
-        to_id = str(matched_edges.iloc[i]['to'])
-        matched_ids.append(from_id + '-' + to_id)
-        coords = matched_edges.iloc[i]['geometry'].coords
-        geom = {
-          'type': 'LineString',
-          'coordinates': [[p[0], p[1]] for p in coords] # TODO
-        }
-        edge_geometries.append(geom)
-        edge_lengths.append(matched_edges.iloc[i]['length'])
+    # Coverage is a bitset over the map's edges, merged in once per COVERAGE_BATCH_ACTIVITIES activities.
+    with db.CoverageWriter(DEFAULT_USER_ID, map_id, graph=graph) as writer:
+      # Activities that never enter the map (e.g. while travelling) are skipped, but still marked processed.
+      pipeline.match_and_write(
+          fetch, unmatched_ids, writer.add, graph_file, prefetch_depth=prefetch_depth, write_queue=write_queue,
+          workers=workers, graph=graph, method=method, boundary=load_map_boundary(map_id), **params)
 
-      db.update_coverage(DEFAULT_USER_ID, map_id, activity_id, matched_ids, edge_geometries, edge_lengths)
+    if writer.failed:
+      logger.warning('Failed to save coverage for {} activities: {}'.format(len(writer.failed), writer.failed))
 
-    return jsonify({'unmatched_ids': len(unmatched_ids)}), 200
+    return jsonify({'unmatched_ids': len(unmatched_ids), 'written': len(writer.written), 'failed': writer.failed,
+                    'updates': writer.num_updates}), 200
 
   except Exception as e:
     logger.exception(e)
@@ -221,6 +325,53 @@ def match_activities(map_id):
 
 #===============================================================================
 
+@app.route('/metrics')
+def prometheus_metrics():
+  """
+  Stage latency histograms and call counters, in the Prometheus text format.
+  """
+  return Response(metrics.render_prometheus(), mimetype='text/plain; version=0.0.4')
+
+#===============================================================================
+
+@app.route('/action/cache-stats')
+def cache_stats():
+  """
+  Show the hit rate and size of the database read cache (debugging).
+  """
+  return jsonify(db.cache_stats()), 200
+
+#===============================================================================
+
+@app.route('/action/graph-stats')
+def graph_stats():
+  """
+  Show which maps are loaded in this process, and the registry hit/miss counts (debugging).
+  """
+  return jsonify(default_registry().stats()), 200
+
+#===============================================================================
+
+@app.route('/data/coverage/<map_id>')
+def get_coverage_json(map_id):
+  """
+  Get the user's coverage of a map as a compact bitset over the edges in
+  'static/graph_geojson/<map_id>.geojson' (see python/coverage_bits.py), for
+  the map page when the storage backend isn't Firebase (otherwise it reads it
+  straight from Firebase).
+  """
+  return jsonify(db.get_coverage(DEFAULT_USER_ID, map_id)), 200
+
+
+@app.route('/data/activities')
+def get_activities_json():
+  """
+  Get the user's activities, for the map page (see get_coverage_json).
+  """
+  return jsonify(db.get_activity_data(DEFAULT_USER_ID)), 200
+
+#===============================================================================
+
 @app.route('/action/activity/<activity_id>')
 def get_activity_json(activity_id):
   """
@@ -0,0 +1,211 @@
+"""
+Offline benchmarks for the matching pipeline, using the activities in
+static/data.csv and the Cambridge GeoPackage.
+
+Run from the top of the repo:
+
+  python -m benchmarks.bench_matching                  # Compare against benchmarks/baseline.json
+  python -m benchmarks.bench_matching --save-baseline  # Record a new baseline
+
+Each stage is run once "cold" (fresh state: nothing loaded, no indexes or
+caches built yet) and then several times "warm". Throughput is reported for
+the fastest warm run. The regression check compares the median warm run
+with the baseline's, which is much less noisy than the mean on a shared
+machine and doesn't hinge on one lucky (or unlucky) sample like the fastest
+run does. The run fails if any stage's median throughput drops more than
+--threshold below the baseline.
+"""
+import argparse
+import json
+import math
+import os
+import platform
+import shutil
+import statistics
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+import polyline
+
+from python.file_util import graph_data_folder, static_folder, top_folder
+import python.matching as matching
+from python.match_graph import MatchGraph
+
+
+DEFAULT_BASELINE = top_folder('benchmarks/baseline.json')
+GRAPH_FILE = graph_data_folder('CAMBRIDGE_MA_US.gpkg')
+
+
+def load_activities(scale=1):
+  """
+  Decode the activity polylines in static/data.csv into [lng, lat] arrays,
+  repeated scale times.
+  """
+  df = pd.read_csv(static_folder('data.csv'))
+  activities = [np.array(polyline.decode(p), dtype=np.float64)[:, ::-1] for p in df['polyline']]
+  return activities * scale
+
+
+def time_stage(setup, run, repeat, min_sample_s=0.1):
+  """
+  Time run(state) once right after setup() (cold), then repeat more times on
+  the same state (warm). Fast stages are called several times per warm sample
+  (like timeit), so each sample takes at least min_sample_s.
+
+  Returns:
+    (tuple) of the cold time, and the fastest and median warm times per call, in seconds.
+  """
+  state = setup()
+  t0 = time.perf_counter()
+  run(state)
+  cold = time.perf_counter() - t0
+
+  t0 = time.perf_counter()
+  run(state)
+  number = max(1, int(math.ceil(min_sample_s / max(time.perf_counter() - t0, 1e-6))))
+
+  warm = []
+  for _ in range(repeat):
+    t0 = time.perf_counter()
+    for _ in range(number):
+      run(state)
+    warm.append((time.perf_counter() - t0) / number)
+
+  return cold, min(warm), statistics.median(warm)
+
+
+def run_benchmarks(scale=25, repeat=7):
+  """
+  Returns:
+    (dict) of stage name to {'cold_s', 'warm_s', 'warm_median_s', 'items', 'unit', 'per_s'}.
+  """
+  activities = load_activities(scale)
+  num_points = sum(len(a) for a in activities)
+  results = {}
+
+  def record(name, items, unit, setup, run):
+    cold, warm, warm_median = time_stage(setup, run, repeat)
+    results[name] = {'cold_s': cold, 'warm_s': warm, 'warm_median_s': warm_median, 'items': items, 'unit': unit,
+                     'per_s': items / warm}
+    print('{:<28} cold {:9.2f} ms   warm {:9.2f} ms   {:12.0f} {}/s'.format(
+        name, 1e3 * cold, 1e3 * warm, items / warm, unit))
+
+  # Copy the GeoPackage somewhere else, so the cold runs really build the binary cache.
+  tmp = tempfile.mkdtemp(prefix='everystreet-bench-')
+  try:
+    graph_file = os.path.join(tmp, os.path.basename(GRAPH_FILE))
+    shutil.copy(GRAPH_FILE, graph_file)
+
+    record('load_graph', 1, 'graph', lambda: None, lambda _: matching.load_graph(graph_file))
+    nodes_df, _ = matching.load_graph(graph_file)
+    record('load_match_graph', 1, 'graph', lambda: None, lambda _: matching.load_match_graph(graph_file))
+    record('kdtree_from_gdf', len(nodes_df), 'node', lambda: None, lambda _: matching.kdtree_from_gdf(nodes_df))
+
+    folder = matching.match_graph.cache_folder_for(graph_file)
+    fresh_graph = lambda: MatchGraph.load(folder)
+    graph = fresh_graph()
+
+    def resample_all(_):
+      for a in activities:
+        matching.resample_points(a, spacing=15.0, transformer=graph.transformer)
+    record('resample_points', num_points, 'point', lambda: None, resample_all)
+
+    # Per activity, the way the app used to do it (the cold run also builds the KDtree and edge lookup).
+    def match_each(g):
+      for a in activities:
+        xy = matching.resample_points(a, spacing=15.0, transformer=g.transformer)
+        matching.match_points_to_edges(xy, g, None, g.kdtree, max_node_dist=30)
+    record('match_points_to_edges', num_points, 'point', fresh_graph, match_each)
+
+    record('match_activities_batch', num_points, 'point', fresh_graph,
+           lambda g: matching.match_activities_batch(activities, g))
+    record('match_by_segments', num_points, 'point', fresh_graph,
+           lambda g: matching.match_activities_by_segments(activities, g))
+
+    # The serialization loop in app.match_activities.
+    matched = matching.match_activities_batch(activities, graph)
+    num_edges = sum(len(m) for m in matched)
+    record('edge_records', num_edges, 'edge', lambda: None,
+           lambda _: [matching.edge_records(graph, m) for m in matched])
+  finally:
+    shutil.rmtree(tmp, ignore_errors=True)
+
+  return results
+
+
+def median_per_s(result):
+  """
+  Throughput of a stage's median warm run (or its fastest, for results saved before medians were recorded).
+  """
+  if 'warm_median_s' not in result:
+    return result['per_s']
+  return result['items'] / result['warm_median_s']
+
+
+def compare(results, baseline, threshold):
+  """
+  Get the stages whose median throughput is more than threshold (a fraction) below the baseline.
+  """
+  regressions = []
+  for name, base in baseline['results'].items():
+    if name not in results:
+      continue
+    ratio = median_per_s(results[name]) / median_per_s(base)
+    if ratio < 1.0 - threshold:
+      regressions.append((name, ratio))
+  return regressions
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--baseline', default=DEFAULT_BASELINE, help='Baseline JSON file.')
+  parser.add_argument('--save-baseline', action='store_true', help='Write the results as the new baseline.')
+  parser.add_argument('--output', help='Also write the results to this JSON file.')
+  parser.add_argument('--threshold', type=float, default=0.25,
+                      help='Allowed drop in throughput vs. the baseline, as a fraction.')
+  parser.add_argument('--scale', type=int, default=25, help='Number of copies of the activities to match.')
+  parser.add_argument('--repeat', type=int, default=7, help='Number of warm runs per stage.')
+  args = parser.parse_args()
+
+  results = run_benchmarks(scale=args.scale, repeat=args.repeat)
+  report = {
+    'machine': {'python': platform.python_version(), 'numpy': np.__version__, 'platform': platform.platform(),
+                'cpus': os.cpu_count()},
+    'scale': args.scale,
+    'results': results,
+  }
+
+  if args.output:
+    with open(args.output, 'w') as f:
+      json.dump(report, f, indent=2)
+
+  if args.save_baseline:
+    with open(args.baseline, 'w') as f:
+      json.dump(report, f, indent=2)
+    print('Saved baseline to {}'.format(args.baseline))
+    return 0
+
+  if not os.path.exists(args.baseline):
+    print('No baseline at {} (run with --save-baseline first)'.format(args.baseline))
+    return 0
+
+  with open(args.baseline, 'r') as f:
+    baseline = json.load(f)
+  if baseline.get('scale') != args.scale:
+    print('WARNING: baseline was recorded with --scale {}'.format(baseline.get('scale')))
+
+  regressions = compare(results, baseline, args.threshold)
+  for name, ratio in regressions:
+    print('REGRESSION: {} is at {:.0f}% of the baseline median throughput'.format(name, 100 * ratio))
+  if regressions:
+    return 1
+
+  print('No regressions beyond {:.0f}% of the baseline'.format(100 * args.threshold))
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
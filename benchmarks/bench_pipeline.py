@@ -0,0 +1,106 @@
+"""
+Wall-clock benchmark of matching stored activities one step at a time
+against the read/match/write pipeline (see python/pipeline.py), the way the
+match-activities action runs them.
+
+The activities in static/data.csv are stored in a temporary SQLite database
+(see python/sqlite_api.py). Every read and coverage write also waits for
+--read-latency-ms / --write-latency-ms, to stand in for the round trips to a
+remote database like Firebase.
+
+Run from the top of the repo:
+
+  python -m benchmarks.bench_pipeline
+  python -m benchmarks.bench_pipeline --read-latency-ms 0 --write-latency-ms 0 --workers 4
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from benchmarks.bench_matching import GRAPH_FILE
+from benchmarks.bench_storage import strava_activities
+from python.map_boundary import load_map_boundary
+import python.matching as matching
+import python.pipeline as pipeline
+import python.storage as storage
+
+
+def run(backend, user_id, map_id, graph, boundary, activity_ids, args, prefetch_depth, write_queue):
+  """
+  Returns:
+    (tuple) of the wall-clock time in seconds, and the user's coverage afterwards.
+  """
+  backend.clear_user_coverage(user_id, map_id)
+
+  def fetch(activity_id):
+    time.sleep(args.read_latency_ms / 1e3)
+    return storage.activity_coordinates(backend.get_activity_by_id(user_id, activity_id))
+
+  t0 = time.perf_counter()
+  with backend.CoverageWriter(user_id, map_id, graph=graph, max_activities=args.coverage_batch) as writer:
+    flush = writer.flush
+    def slow_flush():
+      time.sleep(args.write_latency_ms / 1e3)
+      flush()
+    writer.flush = slow_flush
+
+    pipeline.match_and_write(fetch, activity_ids, writer.add, GRAPH_FILE, prefetch_depth=prefetch_depth,
+                             write_queue=write_queue, workers=args.workers, graph=graph, boundary=boundary,
+                             spacing=15.0, max_node_dist=30)
+  return time.perf_counter() - t0, backend.get_coverage(user_id, map_id)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--scale', type=int, default=50, help='Number of copies of the activities to match.')
+  parser.add_argument('--workers', type=int, default=1, help='Number of matching processes.')
+  parser.add_argument('--read-latency-ms', type=float, default=20.0, help='Added time per activity read.')
+  parser.add_argument('--write-latency-ms', type=float, default=100.0, help='Added time per coverage write.')
+  parser.add_argument('--coverage-batch', type=int, default=25, help='Activities per coverage write.')
+  parser.add_argument('--prefetch', type=int, default=pipeline.default_prefetch(),
+                      help='Activities read ahead of matching in the pipeline.')
+  parser.add_argument('--write-queue', type=int, default=pipeline.default_write_queue(),
+                      help='Matched activities that can wait to be written in the pipeline.')
+  args = parser.parse_args()
+
+  user_id = 'bench'
+  map_id = os.path.splitext(os.path.basename(GRAPH_FILE))[0]
+  graph = matching.load_match_graph(GRAPH_FILE)
+  boundary = load_map_boundary(map_id)
+
+  tmp = tempfile.mkdtemp(prefix='everystreet-bench-')
+  os.environ.setdefault('SQLITE_DB_PATH', os.path.join(tmp, 'bench.sqlite3'))
+
+  try:
+    backend = storage.load_backend('sqlite')
+    activities = strava_activities(args.scale)
+    backend.add_or_update_activities(user_id, activities)
+    activity_ids = [str(a) for a, _ in activities]
+
+    modes = [
+      ('serial', 0, 0),
+      ('prefetch', args.prefetch, 0),
+      ('pipeline', args.prefetch, args.write_queue),
+    ]
+    results = {}
+    for name, prefetch_depth, write_queue in modes:
+      results[name] = run(backend, user_id, map_id, graph, boundary, activity_ids, args, prefetch_depth,
+                          write_queue)
+
+    serial_s, serial_coverage = results['serial']
+    for name, prefetch_depth, write_queue in modes:
+      seconds, coverage = results[name]
+      print('{:<9} prefetch={:<3d} write_queue={:<3d} {:4d} activities in {:7.3f} s ({:6.1f}/s)  {:5.2f}x  {}'.format(
+          name, prefetch_depth, write_queue, len(activity_ids), seconds, len(activity_ids) / seconds,
+          serial_s / seconds, 'same coverage' if coverage == serial_coverage else 'DIFFERENT COVERAGE'))
+  finally:
+    shutil.rmtree(tmp, ignore_errors=True)
+
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
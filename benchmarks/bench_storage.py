@@ -0,0 +1,101 @@
+"""
+Bulk-ingest benchmark for the storage backends (see python/storage.py): how
+fast the activities in static/data.csv and their coverage of the Cambridge
+map can be written, the way the app writes them.
+
+Run from the top of the repo:
+
+  python -m benchmarks.bench_storage                                   # SQLite only, in a temporary file
+  python -m benchmarks.bench_storage --backends sqlite,firebase --user-id bench
+
+Firebase is only benchmarked when asked for, since it writes to the real
+database (under --user-id, which is cleared before and after).
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+from benchmarks.bench_matching import GRAPH_FILE, load_activities
+from python.file_util import static_folder
+import python.matching as matching
+import python.storage as storage
+
+
+def strava_activities(scale):
+  """
+  Fake Strava activities made from static/data.csv, repeated scale times with distinct ids.
+  """
+  df = pd.read_csv(static_folder('data.csv'))
+  activities = []
+  for k in range(scale):
+    for i, p in enumerate(df['polyline']):
+      activities.append((1000000 * (k + 1) + i, {
+        'map': {'polyline': p}, 'name': 'Activity {}'.format(i), 'distance': 1000.0 + i,
+        'start_date': '2022-01-01T00:00:00Z', 'moving_time': 600 + i}))
+  return activities
+
+
+def run_backend(backend, user_id, map_id, activities, matched, graph, batch_size):
+  """
+  Returns:
+    (dict) with the time to add the activities and to write their coverage, in seconds.
+  """
+  backend.clear_user_activities(user_id)
+  backend.clear_user_coverage(user_id, map_id)
+
+  t0 = time.perf_counter()
+  for i in range(0, len(activities), batch_size):
+    backend.add_or_update_activities(user_id, activities[i:i+batch_size])
+  t_activities = time.perf_counter() - t0
+
+  t0 = time.perf_counter()
+  with backend.CoverageWriter(user_id, map_id, graph=graph) as writer:
+    for (activity_id, _), edge_idx in zip(activities, matched):
+      writer.add(activity_id, edge_idx)
+  t_coverage = time.perf_counter() - t0
+
+  stats = backend.get_user_stats(user_id)
+  backend.clear_user_activities(user_id)
+  backend.clear_user_coverage(user_id, map_id)
+
+  return {'activities_s': t_activities, 'coverage_s': t_coverage, 'updates': writer.num_updates,
+          'completed_edges': stats['coverage'][map_id]['completed_edges']}
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--backends', default='sqlite', help='Comma separated storage backends to benchmark.')
+  parser.add_argument('--user-id', default='bench', help='User to write the data under.')
+  parser.add_argument('--scale', type=int, default=25, help='Number of copies of the activities to write.')
+  parser.add_argument('--batch-size', type=int, default=50, help='Activities per add_or_update_activities call.')
+  args = parser.parse_args()
+
+  map_id = os.path.splitext(os.path.basename(GRAPH_FILE))[0]
+  graph = matching.load_match_graph(GRAPH_FILE)
+  activities = strava_activities(args.scale)
+  matched = matching.match_activities_batch(load_activities(args.scale), graph)
+  num_edges = sum(len(m) for m in matched)
+
+  tmp = tempfile.mkdtemp(prefix='everystreet-bench-')
+  os.environ.setdefault('SQLITE_DB_PATH', os.path.join(tmp, 'bench.sqlite3'))
+
+  try:
+    for name in args.backends.split(','):
+      r = run_backend(storage.load_backend(name), args.user_id, map_id, activities, matched, graph,
+                      args.batch_size)
+      print('{:<10} {:6d} activities in {:7.3f} s ({:7.0f}/s)   {:7d} edges in {:7.3f} s ({:8.0f}/s, {} updates)'.format(
+          name, len(activities), r['activities_s'], len(activities) / r['activities_s'],
+          num_edges, r['coverage_s'], num_edges / r['coverage_s'], r['updates']))
+  finally:
+    shutil.rmtree(tmp, ignore_errors=True)
+
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
@@ -0,0 +1,179 @@
+"""
+Per-call latency of the Strava client (see python/strava_api.py) against a
+local stand-in for the Strava API, with a fresh connection per request
+(plain requests.get, like the client used to do) and with the shared
+keep-alive session.
+
+The stand-in serves HTTPS with a self-signed certificate, so each new
+connection pays for a real TLS handshake. It can also answer a fraction of
+requests with a 503 (--fail-rate), to check that the session retries them.
+
+Run from the top of the repo:
+
+  python -m benchmarks.bench_strava
+  python -m benchmarks.bench_strava --fail-rate 0.1 --threads 8
+"""
+import argparse
+import datetime
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import ipaddress
+import json
+import os
+import random
+import shutil
+import ssl
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+import requests
+
+import python.strava_api as strava
+
+
+def write_self_signed_cert(folder):
+  """
+  Returns:
+    (tuple) of the certificate and key files, for 127.0.0.1.
+  """
+  from cryptography import x509
+  from cryptography.hazmat.primitives import hashes, serialization
+  from cryptography.hazmat.primitives.asymmetric import ec
+  from cryptography.x509.oid import NameOID
+
+  key = ec.generate_private_key(ec.SECP256R1())
+  name = x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, '127.0.0.1')])
+  now = datetime.datetime.now(datetime.timezone.utc)
+  cert = (x509.CertificateBuilder().subject_name(name).issuer_name(name).public_key(key.public_key())
+          .serial_number(x509.random_serial_number())
+          .not_valid_before(now - datetime.timedelta(days=1)).not_valid_after(now + datetime.timedelta(days=1))
+          .add_extension(x509.SubjectAlternativeName([x509.IPAddress(ipaddress.ip_address('127.0.0.1'))]),
+                         critical=False)
+          .sign(key, hashes.SHA256()))
+
+  cert_file, key_file = os.path.join(folder, 'cert.pem'), os.path.join(folder, 'key.pem')
+  with open(cert_file, 'wb') as f:
+    f.write(cert.public_bytes(serialization.Encoding.PEM))
+  with open(key_file, 'wb') as f:
+    f.write(key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                              serialization.NoEncryption()))
+  return cert_file, key_file
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+  """
+  Answers the Strava API calls that python/strava_api.py makes, over keep-alive connections.
+  """
+  protocol_version = 'HTTP/1.1'
+  # Headers and body go out in separate writes, which Nagle's algorithm would hold up on a kept-alive connection.
+  disable_nagle_algorithm = True
+  fail_rate = 0.0
+
+  def log_message(self, *args):
+    pass
+
+  def _send(self, status, body):
+    data = json.dumps(body).encode()
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(data)))
+    self.end_headers()
+    self.wfile.write(data)
+
+  def do_GET(self):
+    self.server.requests += 1
+    if random.random() < self.fail_rate:
+      self._send(503, {'message': 'Service Unavailable'})
+    elif self.path.startswith('/api/v3/activities/'):
+      activity_id = int(self.path.split('/')[4].split('?')[0])
+      self._send(200, {'id': activity_id, 'name': 'Run', 'distance': 5000.0, 'moving_time': 1500,
+                       'start_date': '2022-01-01T00:00:00Z', 'map': {'polyline': '_p~iF~ps|U_ulLnnqC'}})
+    else:
+      self._send(404, {'message': 'Not Found'})
+
+  def do_POST(self):
+    self.server.requests += 1
+    self.rfile.read(int(self.headers.get('Content-Length', 0)))
+    self._send(200, {'access_token': 'stand-in'})
+
+
+def start_server(tls_folder, fail_rate):
+  StandInHandler.fail_rate = fail_rate
+  server = ThreadingHTTPServer(('127.0.0.1', 0), StandInHandler)
+  server.daemon_threads = True
+  server.requests = 0
+  if tls_folder is not None:
+    cert_file, key_file = write_self_signed_cert(tls_folder)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert_file, key_file)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    # Both clients verify the stand-in's certificate.
+    os.environ['REQUESTS_CA_BUNDLE'] = cert_file
+  threading.Thread(target=server.serve_forever, daemon=True).start()
+  return server
+
+
+def fresh_connection_get(access_token, id):
+  """
+  How strava.get_activity_by_id used to make its request.
+  """
+  url = strava.STRAVA_URL + '/api/v3/activities/{}'.format(id)
+  return requests.get(url, headers={'Authorization': 'Bearer ' + access_token},
+                      params={'per_page': 200, 'page': 1}).json()
+
+
+def time_calls(get, num_calls, threads):
+  """
+  Returns:
+    (tuple) of the latency of each call in seconds, the total wall-clock time, and the number of calls that failed.
+  """
+  def call(i):
+    t0 = time.perf_counter()
+    try:
+      ok = 'id' in get('stand-in', i)
+    except requests.RequestException:
+      ok = False
+    return time.perf_counter() - t0, ok
+
+  t0 = time.perf_counter()
+  with ThreadPoolExecutor(max_workers=threads) as pool:
+    results = list(pool.map(call, range(num_calls)))
+  return [t for t, _ in results], time.perf_counter() - t0, sum(not ok for _, ok in results)
+
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--calls', type=int, default=500, help='Number of get_activity_by_id calls per client.')
+  parser.add_argument('--threads', type=int, default=1, help='Number of threads making calls at once.')
+  parser.add_argument('--fail-rate', type=float, default=0.0, help='Fraction of requests answered with a 503.')
+  parser.add_argument('--http', action='store_true', help='Serve plain HTTP instead of HTTPS.')
+  args = parser.parse_args()
+
+  tmp = tempfile.mkdtemp(prefix='everystreet-bench-')
+  try:
+    server = start_server(None if args.http else tmp, args.fail_rate)
+    strava.STRAVA_URL = '{}://127.0.0.1:{}'.format('http' if args.http else 'https', server.server_address[1])
+    strava.get_token_always_valid() # Opens the session's first connection.
+
+    clients = [('fresh connections', fresh_connection_get), ('shared session', strava.get_activity_by_id)]
+    for name, get in clients:
+      requests_before = server.requests
+      latencies, wall_s, failed = time_calls(get, args.calls, args.threads)
+      latencies_ms = sorted(1e3 * t for t in latencies)
+      print('{:<18} {} calls in {:6.3f} s  p50 {:6.2f} ms  p95 {:6.2f} ms  mean {:6.2f} ms  '
+            '{} failed  {} requests'.format(
+          name, args.calls, wall_s, statistics.median(latencies_ms),
+          latencies_ms[int(0.95 * (len(latencies_ms) - 1))], statistics.mean(latencies_ms), failed,
+          server.requests - requests_before))
+    server.shutdown()
+  finally:
+    shutil.rmtree(tmp, ignore_errors=True)
+
+  return 0
+
+
+if __name__ == '__main__':
+  sys.exit(main())
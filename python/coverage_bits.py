@@ -0,0 +1,82 @@
+import base64
+
+import numpy as np
+
+
+def empty_bits(num_edges):
+  """
+  Coverage with no completed edges: one bit per edge of the graph, packed
+  into bytes (edge i is bit i % 8 of byte i // 8).
+  """
+  return np.zeros((num_edges + 7) // 8, dtype=np.uint8)
+
+
+def edge_bits(num_edges, idx):
+  """
+  Coverage with just the given edge indices completed.
+  """
+  mask = np.zeros(num_edges, dtype=bool)
+  mask[np.asarray(idx, dtype=np.int64)] = True
+  return np.packbits(mask, bitorder='little')
+
+
+def merge_bits(a, b):
+  """
+  Combine two coverages (the union of their completed edges).
+  """
+  return np.bitwise_or(a, b)
+
+
+def completed_edges(bits, num_edges):
+  """
+  Get the sorted indices of the completed edges.
+  """
+  return np.flatnonzero(np.unpackbits(bits, count=num_edges, bitorder='little'))
+
+
+def coverage_totals(graph, bits):
+  """
+  Returns:
+    (tuple) of the number of completed edges, and their total length in meters.
+  """
+  idx = completed_edges(bits, graph.num_edges)
+  return len(idx), float(graph.edge_length[idx].sum())
+
+
+def to_record(graph, bits):
+  """
+  Get the form coverage is stored and sent to the client in. The bits are
+  only meaningful for the edge order they were made with, so its version is
+  stored alongside them.
+  """
+  return {
+    'version': graph.edge_order_version,
+    'num_edges': graph.num_edges,
+    'bits': base64.b64encode(bits.tobytes()).decode('ascii')
+  }
+
+
+def from_record(graph, record):
+  """
+  Read coverage stored with to_record (or None, for no coverage yet).
+
+  Raises:
+    ValueError if it was stored against a different edge order than graph's.
+  """
+  if record is None:
+    return empty_bits(graph.num_edges)
+  if record['version'] != graph.edge_order_version or record['num_edges'] != graph.num_edges:
+    raise ValueError('Coverage was saved for edge order {} but the graph has {}; clear it and match again'.format(
+        record['version'], graph.edge_order_version))
+  return np.frombuffer(base64.b64decode(record['bits']), dtype=np.uint8).copy()
+
+
+def edge_id_bits(graph, edge_ids):
+  """
+  Coverage with the edges that have the given '<from>-<to>' ids (see
+  MatchGraph.edge_ids) completed. Parallel edges share an id, so they're all
+  included.
+  """
+  wanted = set(edge_ids)
+  idx = [i for i, e in enumerate(graph.edge_ids(np.arange(graph.num_edges))) if e in wanted]
+  return edge_bits(graph.num_edges, idx)
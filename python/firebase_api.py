@@ -1,16 +1,23 @@
 import base64
+from collections import OrderedDict
 import json
 from math import radians
 import os
+import threading
+import time
 
-import polyline
+import numpy as np
 
 import firebase_admin as fa
 import firebase_admin.db as db
 from firebase_admin import credentials
 
+from python.coverage_bits import edge_bits, edge_id_bits, from_record, merge_bits, to_record
 from python.file_util import *
-import python.matching as matching
+from python.graph_registry import get_graph
+import python.metrics as metrics
+from python.storage import activity_meta, activity_record, encode_coordinates
+from python.user_stats import METERS_TO_MI, add_activity_totals, set_map_coverage
 
 from dotenv import load_dotenv
 
@@ -24,139 +31,484 @@ fa.initialize_app(cred, {'databaseURL': os.getenv('FIREBASE_DB_URL')})
 
 #===============================================================================
 
+class ReadCache(object):
+  """
+  Read-through cache of database reads, keyed by path (and whether the read
+  was shallow).
+
+  Entries expire after ttl seconds, and the least recently used ones are
+  evicted once there are more than max_entries of them or they take up more
+  than max_bytes (measured as serialized JSON). Writes in this module call
+  invalidate() on the paths they change, which drops every entry at, above or
+  below that path.
+
+  Cached values are shared between callers, so they must not be modified.
+  """
+  def __init__(self, ttl=60.0, max_entries=256, max_bytes=64 * 1024 * 1024):
+    self.ttl = ttl
+    self.max_entries = max_entries
+    self.max_bytes = max_bytes
+
+    self._entries = OrderedDict()
+    self._nbytes = 0
+    self._lock = threading.Lock()
+    self._generation = 0
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+    self.invalidations = 0
+
+  def get(self, path, shallow=False):
+    """
+    Read path (a tuple of keys under the database root), from the cache if possible.
+    """
+    key = (path, shallow)
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is not None and entry[1] < time.monotonic():
+        self._drop(key)
+        self.expirations += 1
+        entry = None
+      if entry is not None:
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry[0]
+      self.misses += 1
+      generation = self._generation
+
+    value = db.reference('/'.join(path)).get(shallow=shallow)
+    nbytes = len(json.dumps(value))
+
+    with self._lock:
+      # Don't store it if something was written while we were reading.
+      if generation == self._generation and nbytes <= self.max_bytes:
+        if key in self._entries:
+          self._drop(key)
+        self._entries[key] = (value, time.monotonic() + self.ttl, nbytes)
+        self._nbytes += nbytes
+        while len(self._entries) > self.max_entries or self._nbytes > self.max_bytes:
+          self._drop(next(iter(self._entries)))
+          self.evictions += 1
+
+    return value
+
+  def _drop(self, key):
+    self._nbytes -= self._entries.pop(key)[2]
+
+  def invalidate(self, path):
+    """
+    Drop the entries for path, and for everything above and below it.
+    """
+    with self._lock:
+      self._generation += 1
+      for key in [k for k in self._entries if k[0][:len(path)] == path or path[:len(k[0])] == k[0]]:
+        self._drop(key)
+        self.invalidations += 1
+
+  def clear(self):
+    with self._lock:
+      self._generation += 1
+      self._entries.clear()
+      self._nbytes = 0
+
+  def stats(self):
+    with self._lock:
+      lookups = self.hits + self.misses
+      return {
+        'hits': self.hits,
+        'misses': self.misses,
+        'hit_rate': self.hits / lookups if lookups > 0 else 0.0,
+        'evictions': self.evictions,
+        'expirations': self.expirations,
+        'invalidations': self.invalidations,
+        'entries': len(self._entries),
+        'nbytes': self._nbytes
+      }
+
+
+CACHE = ReadCache(ttl=float(os.getenv('FIREBASE_CACHE_TTL', 60)),
+                  max_entries=int(os.getenv('FIREBASE_CACHE_MAX_ENTRIES', 256)),
+                  max_bytes=int(float(os.getenv('FIREBASE_CACHE_MAX_MB', 64)) * 1024 * 1024))
+
+
+def cache_stats():
+  return CACHE.stats()
+
+#===============================================================================
+
+@metrics.timed('firebase.get_processed_activity_ids_for_map')
 def get_processed_activity_ids_for_map(user_id, map_id):
   """
   Get a set of all user's activity IDs that have been processed so far.
   """
-  items = db.reference('user_data').child(user_id).child('processed').child(map_id).get()
+  # Only the keys are needed, so don't download the values.
+  items = CACHE.get(('user_data', user_id, 'processed', map_id), shallow=True)
   return set(items.keys()) if items is not None else set()
 
 #===============================================================================
 
+@metrics.timed('firebase.get_activity_data')
 def get_activity_data(user_id):
   """
   Get metadata about user activities that have been processed so far.
   """
-  return db.reference('user_data').child(user_id).child('activity_data').get()
+  return CACHE.get(('user_data', user_id, 'activity_data'))
 
 #===============================================================================
 
+@metrics.timed('firebase.get_activity_ids')
 def get_activity_ids(user_id):
   """
-  Get metadata about user activities that have been processed so far.
+  Get the set of IDs of the user's activities.
   """
-  items = db.reference('user_data').child(user_id).child('activity_data').get()
+  # A shallow read only returns the keys, instead of every activity with its full geometry.
+  items = CACHE.get(('user_data', user_id, 'activity_data'), shallow=True)
   return set(items.keys()) if items is not None else set()
 
 #===============================================================================
 
+@metrics.timed('firebase.get_activity_by_id')
 def get_activity_by_id(user_id, activity_id):
   """
   Get metadata about user activities that have been processed so far.
   """
-  return db.reference('user_data').child(user_id).child('activity_data').child(activity_id).get()
+  return CACHE.get(('user_data', user_id, 'activity_data', str(activity_id)))
 
 #===============================================================================
 
+@metrics.timed('firebase.get_activity_page')
+def get_activity_page(user_id, before=None, limit=50):
+  """
+  Get the metadata (see storage.ACTIVITY_META_FIELDS) of a page of the user's
+  activities, newest first.
+
+  This queries 'user_data/<user_id>/activity_meta' ordered by start_date, so
+  only one page of metadata is downloaded. The database rules need an
+  '.indexOn': 'start_date' there for the query to run on the server.
+
+  Args:
+    user_id (str) : the user whose activities to list.
+    before (tuple) : optional (start_date, activity ID) to start after.
+    limit (int) : maximum number of activities to get.
+
+  Returns:
+    (list) of dicts, ordered by (start_date, activity ID) from newest to oldest.
+  """
+  query = db.reference('user_data').child(user_id).child('activity_meta').order_by_child('start_date')
+  if before is not None:
+    query = query.end_at(before[0])
+
+  # The query can only end at a start_date, so activities on the previous page with the
+  # same start_date as the cursor come back too. Ask for more until there are enough others.
+  # Ties are broken by comparing IDs as strings, like Firebase does for keys as long as Strava's.
+  num = limit
+  while True:
+    items = query.limit_to_last(num).get() or {}
+    rows = sorted(((item['start_date'], key, item) for key, item in items.items()), key=lambda r: r[:2],
+                  reverse=True)
+    if before is not None:
+      rows = [r for r in rows if r[:2] < before]
+    if len(rows) >= limit or len(items) < num:
+      return [item for _, _, item in rows[:limit]]
+    num += limit - len(rows)
+
+#===============================================================================
+
+@metrics.timed('firebase.get_user_stats')
 def get_user_stats(user_id):
   """
   Get user stats from the database.
   """
-  stats = db.reference('user_data').child(user_id).child('stats').get()
+  stats = CACHE.get(('user_data', user_id, 'stats'))
   return {} if stats is None else stats
 
 #===============================================================================
 
+@metrics.timed('firebase.get_coverage')
+def get_coverage(user_id, map_id):
+  """
+  Get the user's coverage of a map, in the form stored by coverage_bits.to_record (or None if there isn't any).
+  """
+  return CACHE.get(('user_data', user_id, 'coverage_bits', map_id))
+
+#===============================================================================
+
+@metrics.timed('firebase.add_or_update_activity')
 def add_or_update_activity(user_id, activity_id, activity_data):
   """
-  Store metadata and raw route information from Strava as a geojson feature.
+  Store metadata from Strava along with the route, as the encoded polyline
+  Strava sends (see storage.activity_record), and add it to the user's stats.
   """
+  add_or_update_activities(user_id, [(activity_id, activity_data)])
 
-  # Also store the decoded coordinates from the activity for faster client-side lookup later.
-  points = [[c[1], c[0]] for c in polyline.decode(activity_data['map']['polyline'])]
 
-  db.reference('user_data').child(user_id).child('activity_data').child(str(activity_id)).update(
-    {
-      'id': activity_id,
-      'name': activity_data['name'],
-      'distance': activity_data['distance'],
-      'start_date': activity_data['start_date'],
-      'moving_time': activity_data['moving_time'],
-      'geometry': {'type': 'LineString', 'coordinates': points}
-    }
-  )
+@metrics.timed('firebase.add_or_update_activities')
+def add_or_update_activities(user_id, activities):
+  """
+  Store many activities (see add_or_update_activity) in a single multi-path
+  update, and add them to the user's stats.
+
+  Args:
+    user_id (str) : the user the activities belong to.
+    activities (list) : of (activity_id, activity_data from Strava) tuples.
+  """
+  ref = db.reference('user_data').child(user_id)
+  existing = get_activity_ids(user_id)
+
+  paths = {}
+  distance, moving_time, count = 0.0, 0.0, 0
+  for key, record in {str(a): activity_record(a, d) for a, d in activities}.items():
+    if key in existing:
+      # Only read the old totals (not the geometry), so that an activity that's pulled again only counts once.
+      # Activities saved before activity_meta existed only have them in activity_data.
+      old = ref.child('activity_meta').child(key).get()
+      if old is None:
+        old = {field: ref.child('activity_data').child(key).child(field).get() for field in ('distance', 'moving_time')}
+      distance -= old.get('distance') or 0
+      moving_time -= old.get('moving_time') or 0
+    else:
+      count += 1
+    distance += record['distance']
+    moving_time += record['moving_time']
+    paths.update(('activity_data/{}/{}'.format(key, field), value) for field, value in record.items())
+    # A copy of just the metadata, for listing activities a page at a time.
+    paths['activity_meta/' + key] = activity_meta(record)
+
+  if not paths:
+    return
+
+  ref.update(paths)
+  CACHE.invalidate(('user_data', user_id, 'activity_data'))
+  CACHE.invalidate(('user_data', user_id, 'activity_meta'))
+  update_user_stats(user_id, lambda stats: add_activity_totals(stats, METERS_TO_MI * distance, moving_time / 3600.0,
+                                                               count))
+
+
+@metrics.timed('firebase.migrate_activity_geometry')
+def migrate_activity_geometry(user_id, batch_size=100):
+  """
+  Convert activities saved with their decoded 'geometry' to the encoded
+  'polyline' that activity_record stores now, and fill in the metadata copy
+  in 'activity_meta' (see get_activity_page) for activities saved before it
+  existed. This can be run more than once.
+
+  Returns:
+    (int) the number of activities that were converted.
+  """
+  ref = db.reference('user_data').child(user_id)
+
+  paths = {}
+  migrated = 0
+  for i, activity_id in enumerate(sorted(get_activity_ids(user_id))):
+    activity = ref.child('activity_data').child(activity_id).get()
+    paths['activity_meta/' + activity_id] = activity_meta(activity)
+    if 'geometry' in activity:
+      paths['activity_data/{}/polyline'.format(activity_id)] = encode_coordinates(activity['geometry']['coordinates'])
+      paths['activity_data/{}/geometry'.format(activity_id)] = None # Deletes it.
+      migrated += 1
+
+    if (i + 1) % batch_size == 0:
+      ref.update(paths)
+      paths = {}
+
+  if paths:
+    ref.update(paths)
+  CACHE.invalidate(('user_data', user_id, 'activity_data'))
+  CACHE.invalidate(('user_data', user_id, 'activity_meta'))
+
+  return migrated
 
 #===============================================================================
 
-def update_coverage(user_id, map_id, activity_id, edge_ids, edge_geometries, edge_lengths):
+class CoverageWriter(object):
+  """
+  Collects the edges completed by many activities, and saves them once there
+  are max_activities of them (or on flush).
+
+  Coverage is stored as a bitset over the map's edges (see
+  python/coverage_bits.py), at 'user_data/<user_id>/coverage_bits/<map_id>'.
+  Saving ORs the new edges into it in a transaction, then marks the activities
+  processed for the map in one multi-path update. Merging is idempotent, so an
+  activity that's matched again (e.g. because its processed flag didn't get
+  saved) doesn't change anything.
+
+  If a write fails, each of its activities is put in 'failed' (activity id ->
+  error message) instead of raising, and the ids that were saved are in
+  'written'. The map's coverage stats are worked out again from the merged
+  bits after each write, so they can't drift.
+
+  Usage:
+    with CoverageWriter(user_id, map_id, graph=graph) as writer:
+      for activity_id, edge_idx in results:
+        writer.add(activity_id, edge_idx)
+  """
+  def __init__(self, user_id, map_id, graph=None, max_activities=None):
+    """
+    Args:
+      user_id (str) : the user to write coverage for.
+      map_id (str) : the map the edges are from.
+      graph (MatchGraph) : optional graph for the map. Taken from the graph
+        registry if not given.
+      max_activities (int) : number of activities to collect before writing
+        them. Defaults to the COVERAGE_BATCH_ACTIVITIES environment variable, or 500.
+    """
+    self.user_id = user_id
+    self.map_id = map_id
+    self.graph = graph
+    self.max_activities = max_activities if max_activities is not None else \
+        int(os.getenv('COVERAGE_BATCH_ACTIVITIES', 500))
+
+    self._pending = []
+
+    self.written = []
+    self.failed = {}
+    self.num_updates = 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.flush()
+
+  def add(self, activity_id, edge_idx):
+    """
+    Args:
+      activity_id (str) : the activity that was matched.
+      edge_idx (np.ndarray) : indices of the edges it completed, in the map's graph.
+    """
+    self._pending.append((str(activity_id), np.asarray(edge_idx, dtype=np.int64)))
+    if len(self._pending) >= self.max_activities:
+      self.flush()
+
+  @metrics.timed('firebase.coverage_flush')
+  def flush(self):
+    """
+    Write everything that's been added so far.
+    """
+    pending, self._pending = self._pending, []
+    if not pending:
+      return
+
+    if self.graph is None:
+      self.graph = get_graph(self.map_id)
+    graph = self.graph
+    bits = edge_bits(graph.num_edges, np.concatenate([idx for _, idx in pending]))
+
+    ref = db.reference('user_data').child(self.user_id)
+    try:
+      self.num_updates += 1
+      record = ref.child('coverage_bits').child(self.map_id).transaction(
+          lambda record: to_record(graph, merge_bits(from_record(graph, record), bits)))
+      self.num_updates += 1
+      ref.update({'processed/{}/{}'.format(self.map_id, activity_id): 1 for activity_id, _ in pending})
+      self.written.extend(activity_id for activity_id, _ in pending)
+    except Exception as e:
+      self.failed.update((activity_id, str(e)) for activity_id, _ in pending)
+      return
+    finally:
+      CACHE.invalidate(('user_data', self.user_id, 'processed', self.map_id))
+      CACHE.invalidate(('user_data', self.user_id, 'coverage_bits', self.map_id))
+
+    update_user_stats(self.user_id, lambda stats: set_map_coverage(stats, self.map_id, graph,
+                                                                   from_record(graph, record)))
+
+
+@metrics.timed('firebase.update_coverage')
+def update_coverage(user_id, map_id, activity_id, edge_idx, graph=None):
   """
   Save completed edges to the database for visualization and coverage metrics.
+  Use a CoverageWriter instead to save many activities at once.
+  """
+  writer = CoverageWriter(user_id, map_id, graph=graph)
+  writer.add(activity_id, edge_idx)
+  writer.flush()
+  if writer.failed:
+    raise RuntimeError(writer.failed[str(activity_id)])
+
+
+@metrics.timed('firebase.migrate_coverage')
+def migrate_coverage(user_id, map_id, graph=None):
+  """
+  Convert coverage saved as a copy of every completed edge (at
+  'user_data/<user_id>/coverage/<map_id>') into bits, and delete the copies.
+
+  Returns:
+    (int) the number of edge ids that were converted.
   """
-  p = {}
+  if graph is None:
+    graph = get_graph(map_id)
 
-  for i, e in enumerate(edge_ids):
-    p[str(e)] = {
-      'completed_by': {str(activity_id): 1},
-      'geometry': edge_geometries[i],
-      'length': edge_lengths[i]
-    }
+  ref = db.reference('user_data').child(user_id)
+  legacy_ref = ref.child('coverage').child(map_id)
+  edge_ids = legacy_ref.get(shallow=True)
+  if not edge_ids:
+    return 0
 
-  ref = db.reference('user_data').child(user_id).child('coverage').child(map_id)
-  ref.update(p)
+  bits = edge_id_bits(graph, edge_ids)
+  record = ref.child('coverage_bits').child(map_id).transaction(
+      lambda record: to_record(graph, merge_bits(from_record(graph, record), bits)))
+  legacy_ref.delete()
+  CACHE.invalidate(('user_data', user_id, 'coverage_bits', map_id))
+  CACHE.invalidate(('user_data', user_id, 'coverage', map_id))
 
-  # Now indicate that this activity was processed for this map.
-  ref = db.reference('user_data').child(user_id).child('processed').child(map_id)
-  ref.update({activity_id: 1})
+  update_user_stats(user_id, lambda stats: set_map_coverage(stats, map_id, graph, from_record(graph, record)))
+  return len(edge_ids)
 
 #===============================================================================
 
-def update_user_stats(user_id):
+@metrics.timed('firebase.update_user_stats')
+def update_user_stats(user_id, update):
   """
-  Re-compute total user stats over their activities.
+  Apply a change to the user's stats in a transaction, so concurrent changes
+  aren't lost.
+
+  Args:
+    user_id (str) : the user to update.
+    update (callable) : takes the current stats dict (empty if there aren't
+      any yet) and returns the new one, e.g. using add_activity_totals. May be
+      called more than once if the stats change while it runs.
+
+  Returns:
+    (dict) the new stats.
   """
-  stats_ref = db.reference('user_data').child(user_id).child('stats')
-  activities_ref = db.reference('user_data').child(user_id).child('activity_data')
+  ref = db.reference('user_data').child(user_id).child('stats')
+  try:
+    return ref.transaction(lambda stats: update(stats or {}))
+  finally:
+    CACHE.invalidate(('user_data', user_id, 'stats'))
 
-  activities = activities_ref.get()
 
-  total_distance = 0
-  total_time = 0
+@metrics.timed('firebase.recompute_user_stats')
+def recompute_user_stats(user_id, graphs=None):
+  """
+  Re-compute total user stats from scratch, over all of their activities and
+  coverage, and overwrite the ones that are kept up to date as activities and
+  coverage are added. This downloads every activity, so it's only meant for
+  repairing the stats (e.g. after a write that failed part way).
+
+  Args:
+    user_id (str) : the user to update.
+    graphs (dict) : optional map_id to MatchGraph. Maps that aren't in it are
+      taken from the graph registry.
+  """
+  stats_ref = db.reference('user_data').child(user_id).child('stats')
+  activities = db.reference('user_data').child(user_id).child('activity_data').get() or {}
+
+  p = add_activity_totals({}, 0.0, 0.0, 0)
   for item in activities.values():
-    total_distance += 0.621371 * item['distance'] / 1000
-    total_time += item['moving_time'] / 3600.0
-
-  map_id = 'CAMBRIDGE_MA_US'
-
-  # Get completed edges from the databse.
-  r = db.reference('user_data').child(user_id).child('coverage').child(map_id).get()
-
-  # Get the entire edge set from disk.
-  _, edges_df = matching.load_graph(graph_data_folder('{}.gpkg'.format(map_id)))
-
-  completed_distance = 0
-  for key in r:
-    completed_distance += r[key]['length']
-
-  meters_to_mi = 0.621371 / 1000
-  total_map_dist = edges_df['length'].sum() * meters_to_mi
-  compl_map_dist = completed_distance * meters_to_mi
-
-  p = {
-    'total_distance': total_distance,
-    'total_activities': len(activities.values()),
-    'total_time': total_time,
-    'coverage': {
-      map_id: {
-        'total_distance': total_map_dist,
-        'completed_distance': compl_map_dist,
-        'total_edges': len(edges_df),
-        'completed_edges': len(r) if r is not None else 0,
-        'percent_coverage': 100.0 * compl_map_dist / total_map_dist
-      }
-    }
-  }
+    add_activity_totals(p, METERS_TO_MI * item['distance'], item['moving_time'] / 3600.0, 1)
+
+  # Get completed edges from the database, for every map with coverage.
+  coverage_ref = db.reference('user_data').child(user_id).child('coverage_bits')
+  p['coverage'] = {}
+  for map_id, record in (coverage_ref.get() or {}).items():
+    graph = (graphs or {}).get(map_id) or get_graph(map_id)
+    set_map_coverage(p, map_id, graph, from_record(graph, record))
 
-  stats_ref.update(p)
+  stats_ref.set(p)
+  CACHE.invalidate(('user_data', user_id, 'stats'))
 
   return p
 
@@ -166,10 +518,26 @@ def update_user_stats(user_id):
 
 
 def clear_user_activities(user_id):
-  ref = db.reference('user_data').child(user_id).child('activity_data')
-  ref.delete()
+  ref = db.reference('user_data').child(user_id)
+  ref.child('activity_data').delete()
+  ref.child('activity_meta').delete()
+  CACHE.invalidate(('user_data', user_id, 'activity_data'))
+  CACHE.invalidate(('user_data', user_id, 'activity_meta'))
+
+  def reset(stats):
+    stats.update(add_activity_totals({}, 0.0, 0.0, 0))
+    return stats
+  update_user_stats(user_id, reset)
 
 
 def clear_user_coverage(user_id, map_id):
-  ref = db.reference('user_data').child(user_id).child('coverage').child(map_id)
-  ref.delete()
+  ref = db.reference('user_data').child(user_id)
+  ref.child('coverage_bits').child(map_id).delete()
+  ref.child('coverage').child(map_id).delete()
+  CACHE.invalidate(('user_data', user_id, 'coverage_bits', map_id))
+  CACHE.invalidate(('user_data', user_id, 'coverage', map_id))
+
+  def reset(stats):
+    stats.get('coverage', {}).pop(map_id, None)
+    return stats
+  update_user_stats(user_id, reset)
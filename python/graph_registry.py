@@ -0,0 +1,153 @@
+from collections import OrderedDict
+import logging
+import os
+import threading
+import time
+
+from python.file_util import graph_data_folder
+import python.matching as matching
+
+
+logger = logging.getLogger(__name__)
+
+
+def load_map_from_graph_data(map_id):
+  """
+  Default loader: read 'static/graph_data/<map_id>.gpkg' (through its binary cache).
+  """
+  return matching.load_match_graph(graph_data_folder('{}.gpkg'.format(map_id)))
+
+
+class GraphRegistry(object):
+  """
+  Process-wide store of loaded MatchGraphs (with their spatial indexes), keyed
+  by map_id. The least recently used maps are evicted once there are more than
+  max_maps of them, or they take up more than max_bytes in total.
+
+  Concurrent requests for a map that isn't loaded yet wait on a per-map lock,
+  so each map is only loaded once. Requests for other maps aren't blocked.
+  """
+  def __init__(self, loader=load_map_from_graph_data, max_maps=4, max_bytes=None):
+    """
+    Args:
+      loader (callable) : takes a map_id and returns a MatchGraph.
+      max_maps (int) : maximum number of maps to keep loaded.
+      max_bytes (int) : optional maximum total size of the loaded maps.
+    """
+    self.loader = loader
+    self.max_maps = max_maps
+    self.max_bytes = max_bytes
+
+    self._graphs = OrderedDict()
+    self._lock = threading.Lock()
+    self._load_locks = {}
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  def get(self, map_id):
+    """
+    Get the MatchGraph for map_id, loading it if needed.
+    """
+    with self._lock:
+      graph = self._lookup(map_id)
+      if graph is not None:
+        return graph
+      load_lock = self._load_locks.setdefault(map_id, threading.Lock())
+
+    with load_lock:
+      # Another thread may have loaded it while we were waiting.
+      with self._lock:
+        graph = self._lookup(map_id)
+        if graph is not None:
+          return graph
+        self.misses += 1
+
+      try:
+        t0 = time.perf_counter()
+        graph = self.loader(map_id)
+        graph.kdtree  # Build the index here instead of inside someone's request.
+        logger.info('Loaded map {} ({:.1f} MB) in {:.1f} ms'.format(
+            map_id, graph.nbytes / 1e6, 1e3 * (time.perf_counter() - t0)))
+
+        with self._lock:
+          self._graphs[map_id] = graph
+          self._evict()
+      finally:
+        # Even if loading failed, so that map_ids that can't be loaded don't pile up locks.
+        with self._lock:
+          if self._load_locks.get(map_id) is load_lock:
+            del self._load_locks[map_id]
+
+    return graph
+
+  def evict(self, map_id):
+    """
+    Drop map_id from the registry (e.g. after its graph file changes).
+    """
+    with self._lock:
+      self._graphs.pop(map_id, None)
+
+  def clear(self):
+    with self._lock:
+      self._graphs.clear()
+
+  def stats(self):
+    """
+    Get the hit/miss counters and what is currently loaded.
+    """
+    with self._lock:
+      return {
+        'hits': self.hits,
+        'misses': self.misses,
+        'evictions': self.evictions,
+        'maps': list(self._graphs.keys()),
+        'nbytes': self._nbytes()
+      }
+
+  def _lookup(self, map_id):
+    # Must hold self._lock.
+    graph = self._graphs.get(map_id)
+    if graph is not None:
+      self._graphs.move_to_end(map_id)
+      self.hits += 1
+    return graph
+
+  def _nbytes(self):
+    return sum(graph.nbytes for graph in self._graphs.values())
+
+  def _evict(self):
+    # Must hold self._lock. Always keep the most recently used map.
+    while len(self._graphs) > 1 and (len(self._graphs) > self.max_maps or
+        (self.max_bytes is not None and self._nbytes() > self.max_bytes)):
+      map_id, _ = self._graphs.popitem(last=False)
+      self.evictions += 1
+      logger.info('Evicted map {}'.format(map_id))
+
+#===============================================================================
+
+_REGISTRY = None
+_REGISTRY_LOCK = threading.Lock()
+
+
+def default_registry():
+  """
+  The registry shared by everything in this process. Its budget is set by the
+  GRAPH_REGISTRY_MAX_MAPS and GRAPH_REGISTRY_MAX_MB environment variables.
+  """
+  global _REGISTRY
+  with _REGISTRY_LOCK:
+    if _REGISTRY is None:
+      max_mb = os.getenv('GRAPH_REGISTRY_MAX_MB')
+      _REGISTRY = GraphRegistry(
+        max_maps=int(os.getenv('GRAPH_REGISTRY_MAX_MAPS', 4)),
+        max_bytes=None if max_mb is None else int(float(max_mb) * 1e6))
+    return _REGISTRY
+
+
+def get_graph(map_id):
+  """
+  Get the MatchGraph for map_id from the default registry.
+  """
+  return default_registry().get(map_id)
@@ -0,0 +1,134 @@
+from functools import lru_cache
+import json
+import os
+
+import numpy as np
+import shapely
+
+from python.file_util import map_boundaries_folder
+from python.match_graph import bbox_center, local_transformer, project_points
+
+
+# Meters per degree of latitude, for a (conservative) bounding box in [lng, lat].
+METERS_PER_DEGREE = 111320.0
+
+
+class MapBoundary(object):
+  """
+  A map's boundary polygon, grown by buffer_m meters and prepared for fast
+  point-in-polygon tests.
+
+  Points are first checked against the buffered boundary's bounding box in
+  [lng, lat], so activities that are nowhere near the map are rejected without
+  projecting anything. The rest are projected into the boundary's own local
+  metric projection and tested against the prepared polygon.
+  """
+  def __init__(self, geometry, buffer_m=50.0):
+    """
+    Args:
+      geometry (shapely.Geometry) : the boundary in [lng, lat].
+      buffer_m (float) : distance in meters to grow the boundary by. Should be
+        at least the matcher's distance threshold, so edges along the boundary
+        are still matched.
+    """
+    lng0, lat0 = bbox_center(shapely.get_coordinates(geometry))
+    self.transformer = local_transformer(float(lng0), float(lat0))
+    self.buffer_m = buffer_m
+
+    self.polygon = shapely.buffer(shapely.transform(geometry, lambda xy: project_points(self.transformer, xy)),
+                                  buffer_m)
+    shapely.prepare(self.polygon)
+
+    # The buffer is at most buffer_m in any direction, so pad the [lng, lat] box by at least that much.
+    pad_lat = buffer_m / METERS_PER_DEGREE
+    pad_lng = pad_lat / np.cos(np.radians(max(abs(geometry.bounds[1]), abs(geometry.bounds[3]))))
+    lng_min, lat_min, lng_max, lat_max = geometry.bounds
+    self.bounds = tuple(float(c) for c in (lng_min - pad_lng, lat_min - pad_lat, lng_max + pad_lng, lat_max + pad_lat))
+
+  @classmethod
+  def from_geojson(cls, path, buffer_m=50.0):
+    """
+    Load the union of every feature in a GeoJSON file.
+    """
+    with open(path, 'r') as f:
+      features = json.load(f)['features']
+    geometry = shapely.union_all([shapely.geometry.shape(f['geometry']) for f in features])
+    return cls(shapely.force_2d(geometry), buffer_m=buffer_m)
+
+  def overlaps_bbox(self, points):
+    """
+    Check whether the bounding box of some [lng, lat] points touches the boundary's bounding box.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if len(points) == 0:
+      return False
+    lng_min, lat_min = points.min(axis=0)
+    lng_max, lat_max = points.max(axis=0)
+    return not (lng_max < self.bounds[0] or lat_max < self.bounds[1] or
+                lng_min > self.bounds[2] or lat_min > self.bounds[3])
+
+  def contains(self, points):
+    """
+    Get a bool mask of the [lng, lat] points that are inside the buffered boundary.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    inside = ((points[:, 0] >= self.bounds[0]) & (points[:, 1] >= self.bounds[1]) &
+              (points[:, 0] <= self.bounds[2]) & (points[:, 1] <= self.bounds[3]))
+    xy = project_points(self.transformer, points[inside])
+    inside[inside] = shapely.contains_xy(self.polygon, xy[:, 0], xy[:, 1])
+    return inside
+
+  def clip(self, points):
+    """
+    Split an activity into the runs of consecutive points that are inside the
+    buffered boundary. Each run keeps the point before and after it, so the
+    segments that cross the boundary are still there to be resampled.
+
+    Returns:
+      (list) of (K, 2) arrays of [lng, lat] points. Empty if the activity never enters the map.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+    if not self.overlaps_bbox(points):
+      return []
+
+    inside = self.contains(points)
+    if inside.all():
+      return [points]
+
+    # Grow each run by a point on either side, then find where the runs start and end.
+    keep = inside.copy()
+    keep[1:] |= inside[:-1]
+    keep[:-1] |= inside[1:]
+    edges = np.diff(np.concatenate([[0], keep.astype(np.int8), [0]]))
+    starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+    return [points[s:e] for s, e in zip(starts, ends)]
+
+
+def clip_activities(activities, boundary):
+  """
+  Clip many activities to a boundary (see MapBoundary.clip).
+
+  Returns:
+    (tuple) of the list of runs, and int64 array with the index of the activity
+    each run came from. Activities outside the boundary have no runs.
+  """
+  runs, owner = [], []
+  for i, points in enumerate(activities):
+    clipped = boundary.clip(points)
+    runs.extend(clipped)
+    owner.extend([i] * len(clipped))
+  return runs, np.array(owner, dtype=np.int64)
+
+
+@lru_cache(maxsize=None)
+def load_map_boundary(map_id, buffer_m=50.0):
+  """
+  Load 'static/map_boundaries/<map_id>.geojson' (only once per process).
+
+  Returns:
+    (MapBoundary) or None if the map doesn't have a boundary file.
+  """
+  path = map_boundaries_folder('{}.geojson'.format(map_id))
+  if not os.path.exists(path):
+    return None
+  return MapBoundary.from_geojson(path, buffer_m=buffer_m)
@@ -0,0 +1,438 @@
+from functools import lru_cache
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+from pyproj import Transformer
+import shapely
+from scipy.spatial import cKDTree
+
+from python.segment_index import SegmentIndex
+
+
+class MatchGraph(object):
+  """
+  Compact, array-backed version of a street graph with only the data that the
+  matcher needs. Nodes are referred to by their row index (0...N-1) and edges
+  by their row index (0...E-1), in the order they appear in the GeoPackage.
+
+  Attributes:
+    node_osmid (np.ndarray) : int64[N] OSM ids of the nodes.
+    node_xy (np.ndarray) : float64[N, 2] node [lng, lat] coordinates.
+    origin (np.ndarray) : float64[2] [lng, lat] center of the graph's local metric projection.
+    node_xy_m (np.ndarray) : float64[N, 2] node coordinates in the local projection, in meters.
+    edge_coords_m (np.ndarray) : float64[M, 2] edge_coords in the local projection, in meters.
+    edge_u (np.ndarray) : int32[E] index of each edge's 'u' node.
+    edge_v (np.ndarray) : int32[E] index of each edge's 'v' node.
+    edge_key (np.ndarray) : int32[E] OSMnx key for parallel edges.
+    edge_from (np.ndarray) : int64[E] osmid in the edge's 'from' column.
+    edge_to (np.ndarray) : int64[E] osmid in the edge's 'to' column.
+    edge_length (np.ndarray) : float64[E] edge length in meters.
+    edge_coords (np.ndarray) : float64[M, 2] [lng, lat] coordinates of every edge geometry.
+    edge_coord_offsets (np.ndarray) : int64[E+1] edge i owns edge_coords[offsets[i]:offsets[i+1]].
+    adj_indptr (np.ndarray) : int64[N+1] CSR row pointers for key 0 edges, from 'u' to 'v'.
+    adj_node (np.ndarray) : int32[A] CSR column ('v' node index) for each adjacency entry.
+    adj_edge (np.ndarray) : int32[A] edge index for each adjacency entry.
+    edge_id_text (np.ndarray) : uint8[B] '<from>-<to>' id of every edge, each followed by a newline.
+    edge_id_offsets (np.ndarray) : int64[E+1] edge i's id is edge_id_text[offsets[i]:offsets[i+1]].
+    edge_geojson_text (np.ndarray) : uint8[C] compact GeoJSON LineString of every edge, each followed by a comma.
+    edge_geojson_offsets (np.ndarray) : int64[E+1] edge i's GeoJSON is edge_geojson_text[offsets[i]:offsets[i+1]].
+  """
+  ARRAYS = ('node_osmid', 'node_xy', 'edge_u', 'edge_v', 'edge_key', 'edge_from', 'edge_to',
+            'edge_length', 'edge_coords', 'edge_coord_offsets', 'adj_indptr', 'adj_node', 'adj_edge',
+            'origin', 'node_xy_m', 'edge_coords_m', 'edge_id_text', 'edge_id_offsets', 'edge_geojson_text',
+            'edge_geojson_offsets')
+
+  def __init__(self, node_osmid, node_xy, edge_u, edge_v, edge_key, edge_from, edge_to,
+               edge_length, edge_coords, edge_coord_offsets, adj_indptr=None, adj_node=None, adj_edge=None,
+               origin=None, node_xy_m=None, edge_coords_m=None, edge_id_text=None, edge_id_offsets=None,
+               edge_geojson_text=None, edge_geojson_offsets=None):
+    self.node_osmid = node_osmid
+    self.node_xy = node_xy
+    self.edge_u = edge_u
+    self.edge_v = edge_v
+    self.edge_key = edge_key
+    self.edge_from = edge_from
+    self.edge_to = edge_to
+    self.edge_length = edge_length
+    self.edge_coords = edge_coords
+    self.edge_coord_offsets = edge_coord_offsets
+
+    if adj_indptr is None:
+      adj_indptr, adj_node, adj_edge = build_adjacency(len(node_osmid), edge_u, edge_v, edge_key)
+
+    self.adj_indptr = adj_indptr
+    self.adj_node = adj_node
+    self.adj_edge = adj_edge
+
+    if origin is None:
+      origin = bbox_center(node_xy)
+    self.origin = origin
+    self.transformer = local_transformer(float(origin[0]), float(origin[1]))
+
+    if node_xy_m is None:
+      node_xy_m = project_points(self.transformer, node_xy)
+    self.node_xy_m = node_xy_m
+
+    if edge_coords_m is None:
+      edge_coords_m = project_points(self.transformer, edge_coords)
+    self.edge_coords_m = edge_coords_m
+
+    # Output records are serialized once here, so matching results only need to be gathered.
+    if edge_id_text is None:
+      edge_id_text, edge_id_offsets = pack_strings(
+          '{}-{}\n'.format(f, t) for f, t in zip(edge_from.tolist(), edge_to.tolist()))
+    self.edge_id_text = edge_id_text
+    self.edge_id_offsets = edge_id_offsets
+
+    if edge_geojson_text is None:
+      edge_geojson_text, edge_geojson_offsets = pack_strings(
+          json.dumps({'type': 'LineString', 'coordinates': c.tolist()}, separators=(',', ':')) + ','
+          for c in np.split(edge_coords, edge_coord_offsets[1:-1]))
+    self.edge_geojson_text = edge_geojson_text
+    self.edge_geojson_offsets = edge_geojson_offsets
+
+    self._kdtree = None
+    self._segment_index = None
+    self._adj_keys = None
+    self._total_length = None
+    self._edge_order_version = None
+
+  @classmethod
+  def from_gdfs(cls, nodes_df, edges_df):
+    """
+    Build from node/edge GeoDataFrames indexed as returned by matching.load_graph.
+    """
+    node_osmid = nodes_df.index.to_numpy(dtype=np.int64)
+    node_xy = shapely.get_coordinates(nodes_df.geometry.values).astype(np.float64)
+
+    # Map edge endpoint osmids to node rows.
+    sorter = np.argsort(node_osmid)
+    u_osmid = edges_df.index.get_level_values('u').to_numpy(dtype=np.int64)
+    v_osmid = edges_df.index.get_level_values('v').to_numpy(dtype=np.int64)
+    edge_u = sorter[np.searchsorted(node_osmid, u_osmid, sorter=sorter)].astype(np.int32)
+    edge_v = sorter[np.searchsorted(node_osmid, v_osmid, sorter=sorter)].astype(np.int32)
+    assert (node_osmid[edge_u] == u_osmid).all() and (node_osmid[edge_v] == v_osmid).all()
+
+    edge_coords, coord_edge = shapely.get_coordinates(edges_df.geometry.values, return_index=True)
+    edge_coord_offsets = np.zeros(len(edges_df) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(coord_edge, minlength=len(edges_df)), out=edge_coord_offsets[1:])
+
+    return cls(
+      node_osmid,
+      node_xy,
+      edge_u,
+      edge_v,
+      edges_df.index.get_level_values('key').to_numpy(dtype=np.int32),
+      edges_df['from'].to_numpy(dtype=np.int64),
+      edges_df['to'].to_numpy(dtype=np.int64),
+      edges_df['length'].to_numpy(dtype=np.float64),
+      edge_coords.astype(np.float64),
+      edge_coord_offsets)
+
+  @classmethod
+  def load(cls, folder, mmap_mode='r'):
+    """
+    Load a graph that was written with save(). By default the arrays are memory
+    mapped read-only, so loading is nearly free and the pages are shared
+    between every process that opens the same files.
+    """
+    return cls(**{name: np.load(os.path.join(folder, name + '.npy'), mmap_mode=mmap_mode)
+                  for name in MatchGraph.ARRAYS})
+
+  def save(self, folder):
+    """
+    Write each array as a raw .npy file in folder.
+    """
+    os.makedirs(folder, exist_ok=True)
+    for name in MatchGraph.ARRAYS:
+      np.save(os.path.join(folder, name + '.npy'), np.ascontiguousarray(getattr(self, name)))
+
+  @property
+  def num_nodes(self):
+    return len(self.node_osmid)
+
+  @property
+  def num_edges(self):
+    return len(self.edge_length)
+
+  @property
+  def total_length(self):
+    """
+    Sum of the edge lengths in meters, computed the first time it's needed.
+    """
+    if self._total_length is None:
+      self._total_length = float(self.edge_length.sum())
+    return self._total_length
+
+  @property
+  def edge_order_version(self):
+    """
+    Short hash of the order of the edges (by their (u, v, key) OSM ids). Anything
+    stored by edge index (see python/coverage_bits.py) is only valid for graphs
+    with the same version.
+    """
+    if self._edge_order_version is None:
+      h = hashlib.sha256()
+      for a in (self.node_osmid[self.edge_u], self.node_osmid[self.edge_v], self.edge_key):
+        h.update(np.ascontiguousarray(a, dtype=np.int64).tobytes())
+      self._edge_order_version = h.hexdigest()[:16]
+    return self._edge_order_version
+
+  @property
+  def kdtree(self):
+    """
+    KDtree over the projected node coordinates (so distances are in meters),
+    built the first time it's needed.
+    """
+    if self._kdtree is None:
+      self._kdtree = cKDTree(self.node_xy_m)
+    return self._kdtree
+
+  @property
+  def segment_index(self):
+    """
+    SegmentIndex over the projected edge geometries, built the first time it's needed.
+    """
+    if self._segment_index is None:
+      self._segment_index = SegmentIndex(self.edge_coords_m, self.edge_coord_offsets)
+    return self._segment_index
+
+  def project(self, points):
+    """
+    Project [lng, lat] points into this graph's local metric coordinates.
+    """
+    return project_points(self.transformer, points)
+
+  @property
+  def nbytes(self):
+    """
+    Total size of the graph arrays in bytes, plus the spatial indexes that have been built.
+    """
+    total = sum(getattr(self, name).nbytes for name in MatchGraph.ARRAYS)
+    if self._kdtree is not None:
+      total += self._kdtree.data.nbytes + self._kdtree.indices.nbytes
+    if self._segment_index is not None:
+      total += self._segment_index.nbytes
+    return total
+
+  def edge_coords_of(self, e):
+    """
+    Get the (K, 2) array of [lng, lat] coordinates along edge e.
+    """
+    return self.edge_coords[self.edge_coord_offsets[e]:self.edge_coord_offsets[e+1]]
+
+  def edge_ids(self, idx):
+    """
+    Get the '<from>-<to>' id strings of some edges.
+    """
+    text, _ = ragged_take(self.edge_id_text, self.edge_id_offsets, np.asarray(idx, dtype=np.int64))
+    return text.tobytes().decode('ascii').split('\n')[:-1]
+
+  def edge_geojson(self, idx):
+    """
+    Get the GeoJSON LineStrings of some edges, as the text of a JSON array.
+    """
+    text, _ = ragged_take(self.edge_geojson_text, self.edge_geojson_offsets, np.asarray(idx, dtype=np.int64))
+    return '[' + text.tobytes().decode('ascii')[:-1] + ']'
+
+  def find_edges(self, u, v):
+    """
+    Look up key 0 edges from u to v, for arrays of node indices.
+
+    Returns:
+      (np.ndarray) int64 edge index for each (u, v) pair, or -1 if there's no such edge.
+    """
+    if self._adj_keys is None:
+      # The CSR is sorted by (u, v), so these keys are sorted too.
+      rows = np.repeat(np.arange(self.num_nodes, dtype=np.int64), np.diff(self.adj_indptr))
+      self._adj_keys = rows * self.num_nodes + self.adj_node
+
+    keys = np.asarray(u, dtype=np.int64) * self.num_nodes + np.asarray(v, dtype=np.int64)
+    pos = np.minimum(np.searchsorted(self._adj_keys, keys), len(self._adj_keys) - 1)
+    found = (self._adj_keys[pos] == keys) if len(self._adj_keys) > 0 else np.zeros(len(keys), dtype=bool)
+    return np.where(found, self.adj_edge[pos], -1).astype(np.int64)
+
+
+def build_adjacency(num_nodes, edge_u, edge_v, edge_key):
+  """
+  Build a CSR adjacency over key 0 edges, pointing from 'u' to 'v'. Each row is
+  sorted by 'v'.
+
+  Returns:
+    (tuple) of indptr int64[N+1], neighbor node int32[A] and edge index int32[A].
+  """
+  edges = np.flatnonzero(edge_key == 0)
+  order = edges[np.lexsort((edge_v[edges], edge_u[edges]))]
+
+  indptr = np.zeros(num_nodes + 1, dtype=np.int64)
+  np.cumsum(np.bincount(edge_u[order], minlength=num_nodes), out=indptr[1:])
+
+  return indptr, edge_v[order].astype(np.int32), order.astype(np.int32)
+
+
+def pack_strings(strings):
+  """
+  Pack ASCII strings into one uint8 array, with int64[K+1] offsets to each one.
+  """
+  strings = list(strings)
+  offsets = np.zeros(len(strings) + 1, dtype=np.int64)
+  np.cumsum(np.array([len(s) for s in strings], dtype=np.int64), out=offsets[1:])
+  return np.frombuffer(''.join(strings).encode('ascii'), dtype=np.uint8).copy(), offsets
+
+
+def ragged_take(values, offsets, idx):
+  """
+  Gather the rows values[offsets[i]:offsets[i+1]] for each i in idx.
+
+  Returns:
+    (tuple) of the gathered rows, and int64[len(idx)+1] offsets into them.
+  """
+  counts = offsets[idx + 1] - offsets[idx]
+  new_offsets = np.zeros(len(idx) + 1, dtype=np.int64)
+  np.cumsum(counts, out=new_offsets[1:])
+  rows = np.repeat(offsets[idx] - new_offsets[:-1], counts) + np.arange(new_offsets[-1])
+  return values[rows], new_offsets
+
+#===============================================================================
+
+def bbox_center(lnglat):
+  """
+  Get the [lng, lat] center of the bounding box around some points.
+  """
+  return (lnglat.min(axis=0) + lnglat.max(axis=0)) / 2
+
+
+@lru_cache(maxsize=None)
+def transformer_to(crs):
+  """
+  Get a (cached) transformer from WGS84 [lng, lat] into crs.
+  """
+  return Transformer.from_crs('EPSG:4326', crs, always_xy=True)
+
+
+def local_transformer(lng0, lat0):
+  """
+  Get a (cached) transformer from WGS84 into a transverse mercator projection
+  centered on (lng0, lat0). Within a city or so of the center, distances in the
+  projection are accurate to well under a millimeter per meter.
+  """
+  return transformer_to('+proj=tmerc +lat_0={} +lon_0={} +k=1 +x_0=0 +y_0=0 +ellps=WGS84 +units=m +no_defs'.format(
+      lat0, lng0))
+
+
+def project_points(transformer, points):
+  """
+  Project an (N, 2) array of [lng, lat] points with a single vectorized call.
+
+  Returns:
+    (np.ndarray) float64[N, 2] of projected [x, y] coordinates.
+  """
+  points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+  x, y = transformer.transform(points[:, 0], points[:, 1])
+  return np.column_stack((x, y))
+
+#===============================================================================
+
+# Bump this whenever the arrays stored in a cache change.
+CACHE_FORMAT_VERSION = 5
+
+
+def cache_folder_for(graph_file):
+  """
+  The binary cache for 'static/graph_data/X.gpkg' lives in 'static/graph_data/X.cache/'.
+  """
+  return os.path.splitext(graph_file)[0] + '.cache'
+
+
+def file_sha256(path):
+  h = hashlib.sha256()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 20), b''):
+      h.update(block)
+  return h.hexdigest()
+
+
+def source_info(graph_file):
+  st = os.stat(graph_file)
+  return {'size': st.st_size, 'mtime_ns': st.st_mtime_ns}
+
+
+def read_cache_meta(folder):
+  try:
+    with open(os.path.join(folder, 'meta.json'), 'r') as f:
+      return json.load(f)
+  except (OSError, ValueError):
+    return None
+
+
+def is_cache_valid(graph_file, folder, version=CACHE_FORMAT_VERSION):
+  """
+  Check whether the cache in folder was built from the current graph_file (in
+  the given format version).
+
+  The size and mtime are checked first. If only the mtime changed (e.g. after a
+  fresh checkout), the cache is still valid as long as the contents hash the same.
+  """
+  meta = read_cache_meta(folder)
+  if meta is None or meta.get('version') != version:
+    return False
+
+  info = source_info(graph_file)
+  if info['size'] != meta['size']:
+    return False
+  if info['mtime_ns'] == meta['mtime_ns']:
+    return True
+
+  if file_sha256(graph_file) != meta['sha256']:
+    return False
+
+  # Same contents, so just remember the new mtime for next time.
+  meta.update(info)
+  try:
+    with open(os.path.join(folder, 'meta.json'), 'w') as f:
+      json.dump(meta, f)
+  except OSError:
+    pass
+  return True
+
+
+def write_cache(graph, graph_file, folder, save=None, version=CACHE_FORMAT_VERSION, **extra_meta):
+  """
+  Save graph as the cache for graph_file. The files are written to a temporary
+  folder that is swapped in at the end, so readers never see a partial cache.
+  The old cache is moved aside before the swap and deleted after it, so there's
+  only a moment between the two renames where the folder is missing (which
+  readers treat as a cache miss, see matching.load_match_graph).
+
+  Args:
+    save (callable) : optional function that writes graph into a folder. Defaults to graph.save.
+    version (int) : format version recorded in the metadata.
+    extra_meta : other values to store in meta.json.
+  """
+  tmp_folder = '{}.tmp-{}'.format(folder, os.getpid())
+  shutil.rmtree(tmp_folder, ignore_errors=True)
+  (save or graph.save)(tmp_folder)
+
+  meta = {'version': version, 'sha256': file_sha256(graph_file)}
+  meta.update(source_info(graph_file))
+  meta.update(extra_meta)
+  with open(os.path.join(tmp_folder, 'meta.json'), 'w') as f:
+    json.dump(meta, f)
+
+  old_folder = '{}.old-{}'.format(folder, os.getpid())
+  shutil.rmtree(old_folder, ignore_errors=True)
+  try:
+    try:
+      os.rename(folder, old_folder)
+    except FileNotFoundError:
+      pass
+    os.rename(tmp_folder, folder)
+  except OSError:
+    # E.g. another process swapped in its own cache first.
+    shutil.rmtree(tmp_folder, ignore_errors=True)
+    raise
+  finally:
+    shutil.rmtree(old_folder, ignore_errors=True)
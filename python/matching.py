@@ -1,10 +1,21 @@
+import json
+import logging
+import time
+
 import geopandas as gpd
 
 import numpy as np
-import pandas as pd
 
 from scipy.spatial import cKDTree
-from shapely.geometry import Point
+import shapely
+
+import python.match_graph as match_graph
+import python.metrics as metrics
+from python.match_graph import MatchGraph, bbox_center, local_transformer, project_points, transformer_to
+import python.tiled_graph as tiled_graph
+
+
+logger = logging.getLogger(__name__)
 
 
 def kdtree_from_points(points):
@@ -12,9 +23,20 @@ def kdtree_from_points(points):
 
 
 def kdtree_from_gdf(df):
-  return cKDTree(np.array(list(df.geometry.apply(lambda x: (x.x, x.y)))))
+  """
+  Build a KDtree over the nodes of a GeoDataFrame or a MatchGraph. A MatchGraph
+  builds its KDtree once and reuses it.
+
+  The tree is built in a local metric projection (see match_graph.local_transformer)
+  so that query distances come out in meters.
+  """
+  if isinstance(df, MatchGraph):
+    return df.kdtree
+  lnglat = shapely.get_coordinates(df.geometry.values)
+  return cKDTree(project_points(local_transformer(*bbox_center(lnglat).tolist()), lnglat))
 
 
+@metrics.timed('graph.read_gpkg')
 def load_graph(graph_file):
   """
   Load GeoPackage as node/edge GeoDataFrames indexed as described in OSMnx docs
@@ -25,134 +47,580 @@ def load_graph(graph_file):
   return nodes_gdf, edges_gdf
 
 
-def resample_points(points, spacing=20):
+@metrics.timed('graph.load')
+def load_match_graph(graph_file, use_cache=True):
+  """
+  Load a GeoPackage straight into a compact MatchGraph. The GeoDataFrames are
+  only used while loading, and are released afterwards.
+
+  With use_cache, the graph is memory mapped from a binary cache next to the
+  GeoPackage (see match_graph.cache_folder_for). The cache is (re)built from
+  the GeoPackage whenever it's missing or out of date, or can't be read (e.g.
+  because another process is swapping in a new one).
+  """
+  if not use_cache:
+    return MatchGraph.from_gdfs(*load_graph(graph_file))
+
+  t0 = time.perf_counter()
+  folder = match_graph.cache_folder_for(graph_file)
+
+  try:
+    if match_graph.is_cache_valid(graph_file, folder):
+      graph = MatchGraph.load(folder)
+      logger.info('Loaded graph cache {} in {:.1f} ms'.format(folder, 1e3 * (time.perf_counter() - t0)))
+      return graph
+  except OSError as e:
+    logger.warning('Could not read graph cache {}: {}'.format(folder, e))
+
+  graph = MatchGraph.from_gdfs(*load_graph(graph_file))
+  try:
+    match_graph.write_cache(graph, graph_file, folder)
+  except OSError as e:
+    # Some deployments (e.g. Lambda) have a read-only filesystem. Just use the graph in memory.
+    logger.warning('Could not write graph cache {}: {}'.format(folder, e))
+    return graph
+
+  logger.info('Rebuilt graph cache {} from {} in {:.1f} ms'.format(
+      folder, graph_file, 1e3 * (time.perf_counter() - t0)))
+  try:
+    return MatchGraph.load(folder)
+  except OSError as e:
+    # Another process is swapping in its own copy. The one in memory is the same graph.
+    logger.warning('Could not read graph cache {}: {}'.format(folder, e))
+    return graph
+
+
+def load_tiled_graph(graph_file, tile_size=1000.0, max_tiles=64):
+  """
+  Open the tiled version of a GeoPackage (see tiled_graph.write_tiles), which
+  only loads the tiles that are asked for.
+
+  The tiles live next to the GeoPackage, and are (re)built from the whole graph
+  whenever they're missing, out of date or were cut with a different tile_size.
+  """
+  folder = tiled_graph.tile_folder_for(graph_file)
+  meta = match_graph.read_cache_meta(folder)
+  if (not match_graph.is_cache_valid(graph_file, folder, version=tiled_graph.TILE_FORMAT_VERSION)
+      or meta.get('tile_size') != float(tile_size)):
+    t0 = time.perf_counter()
+    tiled_graph.write_tiles(load_match_graph(graph_file), graph_file, folder, tile_size)
+    logger.info('Rebuilt graph tiles {} from {} in {:.1f} ms'.format(
+        folder, graph_file, 1e3 * (time.perf_counter() - t0)))
+
+  return tiled_graph.TiledGraph(folder, max_tiles=max_tiles)
+
+
+def densify_segments(xy, spacing, keep=None):
+  """
+  Work out where resampled points fall along a polyline, without building them.
+
+  Each segment i (from point i to i+1) contributes its start point, plus evenly
+  spaced points in between if it's longer than spacing. The final point of the
+  polyline isn't included.
+
+  Args:
+    xy (np.ndarray) : (N, 2) array of points in a metric projection.
+    spacing (float) : Maximum distance between points in meters.
+    keep (np.ndarray) : optional bool[N-1] mask. Segments that aren't kept emit no points.
+
+  Returns:
+    (tuple) of the segment index (int64[M]), the step number k within that segment
+    (int64[M]), and each segment's step count n - 1 (int64[N-1]). A resampled point
+    is at start + k * (end - start) / (n - 1).
+  """
+  dist_to_next = np.hypot(*(xy[1:] - xy[:-1]).T)
+
+  # Segments longer than spacing are split into n points (including both ends), like np.linspace.
+  n = np.ones(len(dist_to_next), dtype=np.int64)
+  long_segments = dist_to_next > spacing
+  n[long_segments] = np.ceil(dist_to_next[long_segments] / spacing).astype(np.int64)
+
+  # Each segment emits its start point and the n-2 points between its ends.
+  counts = np.maximum(n - 1, 1)
+  emitted = counts if keep is None else np.where(keep, counts, 0)
+  seg = np.repeat(np.arange(len(counts)), emitted)
+  k = np.arange(len(seg)) - np.repeat(np.cumsum(emitted) - emitted, emitted)
+
+  return seg, k, counts
+
+
+@metrics.timed('matching.resample')
+def resample_points(points, spacing=20, transformer=None):
   """
   Resample GPS coordinates to make matches more likely.
 
   Args:
-    points (list) : List of [lng, lat] coordinates.
+    points (list or np.ndarray) : List or (N, 2) array of [lng, lat] coordinates.
     spacing (float) : Maximum distance between points in meters.
+    transformer (pyproj.Transformer) : optional projection for measuring distances.
+      Defaults to EPSG:3310.
+
+  Returns:
+    (np.ndarray) of resampled [lng, lat] coordinates.
+  """
+  points = np.asarray(points, dtype=np.float64).reshape(-1, 2)
+  if len(points) < 2:
+    return np.empty((0, 2), dtype=np.float64)
+
+  if transformer is None:
+    transformer = transformer_to('EPSG:3310')
+
+  seg, k, counts = densify_segments(project_points(transformer, points), spacing)
+
+  # Same arithmetic as np.linspace, so that points match the old per-segment version.
+  step = (points[1:] - points[:-1]) / counts[:, None]
+  return k[:, None] * step[seg] + points[seg]
+
+
+def edge_index_from_gdf(edges_df):
   """
-  df = gpd.GeoDataFrame(geometry=[Point(p) for p in points], crs='EPSG:4326')
-  df.to_crs(epsg=3310, inplace=True)
-  dist_to_next = df.distance(df.shift(-1))
-  dist_to_next[len(dist_to_next)-1] = 0
+  Build a hash index from (u, v) node ids to edge row positions in edges_df.
 
-  resampled = []
-  for i in range(len(points)-1):
-    pt = points[i]
-    next = points[i+1]
+  Only edges with key 0 are indexed, since that's the only key the matcher
+  looks up. Build this once per graph and pass it to match_points_to_edges.
+  """
+  u = edges_df.index.get_level_values('u').to_numpy(dtype=np.int64).tolist()
+  v = edges_df.index.get_level_values('v').to_numpy(dtype=np.int64).tolist()
+  key = edges_df.index.get_level_values('key').to_numpy(dtype=np.int64).tolist()
+  return {(u[i], v[i]): i for i in range(len(u)) if key[i] == 0}
 
-    resampled.append(pt)
 
-    if dist_to_next[i] > spacing:
-      n = int(np.ceil(dist_to_next[i] / spacing))
-      lngs = np.linspace(pt[0], next[0], num=n)[1:-1]
-      lats = np.linspace(pt[1], next[1], num=n)[1:-1]
-      resampled.extend(zip(lngs, lats))
+def edge_finder_from_index(edge_index):
+  """
+  Wrap a dict from edge_index_from_gdf as a vectorized find_edges function.
+  """
+  def find_edges(u, v):
+    return np.array([edge_index.get(k, -1) for k in zip(u.tolist(), v.tolist())], dtype=np.int64)
+  return find_edges
 
-  return resampled
 
+@metrics.timed('matching.match_nodes')
+def match_node_candidates(nodes, dists, find_edges, max_node_dist=40, max_tries=10, offsets=None,
+                          block_size=20000):
+  """
+  Core of the matcher, working on plain arrays of nearest-node candidates.
+
+  Every point that's within max_node_dist of a node is a potential start of an
+  edge. For each start, the next max_tries points that are near a node are tried
+  as the end of the edge, in order, and the first one that completes any edge
+  between the start's and end's candidate nodes wins. Every (start, try) pair is
+  checked at once, so there's no Python loop over points.
 
-def match_points_to_edges(points, nodes_df, edges_df, kdtree, max_node_dist=40):
+  Args:
+    nodes (np.ndarray) : (N, 3) array of ids of the 3 nearest nodes to each point.
+    dists (np.ndarray) : (N, 3) array with the distance from each point to those nodes.
+    find_edges (callable) : takes arrays of node ids u and v, and returns the
+      index of the key 0 edge from u to v for each pair (or -1 if there isn't one).
+    max_node_dist (float) : maximum distance for matching a point to a node.
+    max_tries (int) : number of later node matches to try for each starting point.
+    offsets (np.ndarray) : optional int64[A+1] boundaries of separate sequences
+      (e.g. activities) in the points. Edges never span two sequences.
+    block_size (int) : number of start points to check at once, to bound memory.
+
+  Returns:
+    (tuple) of the completed edge indices (int64[K]) in the order they were
+    completed, and int64[A+1] offsets splitting them up by sequence.
+  """
+  n = len(dists)
+  if offsets is None:
+    offsets = np.array([0, n], dtype=np.int64)
+  lengths = np.diff(offsets)
+  seq = np.repeat(np.arange(len(lengths)), lengths)
+
+  # The last two points of a sequence can't start an edge, and the last one can only end one
+  # if the previous near-node point isn't right before it.
+  ends = offsets[1:][lengths > 0] - 1
+  is_last = np.zeros(n, dtype=bool)
+  is_last[ends] = True
+  is_second_last = np.zeros(n, dtype=bool)
+  is_second_last[ends[lengths[lengths > 0] > 1] - 1] = True
+
+  near = (dists[:, 0] <= max_node_dist) & ~is_last
+  prev_near = np.zeros(n, dtype=bool)
+  prev_near[1:] = near[:-1]
+  candidates = np.flatnonzero(near | (is_last & (dists[:, 0] <= max_node_dist) & ~prev_near))
+
+  starts = np.flatnonzero((dists[:, 0] < max_node_dist) & ~is_last & ~is_second_last)
+
+  completed_edges, completed_start, _ = _complete_edges(nodes, dists, candidates, starts, seq, find_edges,
+                                                        max_node_dist, max_tries, block_size)
+  completed_seq = seq[completed_start]
+
+  edge_offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+  np.cumsum(np.bincount(completed_seq, minlength=len(lengths)), out=edge_offsets[1:])
+
+  return completed_edges, edge_offsets
+
+
+def _complete_edges(nodes, dists, candidates, starts, seq, find_edges, max_node_dist, max_tries, block_size):
+  """
+  Try the next max_tries candidates after each start (see match_node_candidates).
+
+  Returns:
+    (tuple) of the completed edge indices, the start point that completed each
+    one, and a bool mask of the starts that are settled: they either completed
+    an edge, or had all max_tries tries available.
+  """
+  completed_edges = []
+  completed_start = []
+  settled = []
+  for lo in range(0, len(starts), block_size):
+    block = starts[lo:lo+block_size]
+
+    # The tries for each start are the next candidates in the same sequence.
+    pos = np.searchsorted(candidates, block)[:, None] + np.arange(1, max_tries + 1)
+    tries = candidates[np.minimum(pos, len(candidates) - 1)]
+    try_valid = (pos < len(candidates)) & (seq[tries] == seq[block][:, None])
+
+    # NOTE(milo): Candidates for j are filtered by the validity of i's neighbors.
+    valid = dists[block] < max_node_dist
+    pair_valid = try_valid[:, :, None, None] & valid[:, None, :, None] & valid[:, None, None, :]
+
+    u = np.broadcast_to(nodes[block][:, None, :, None], pair_valid.shape)[pair_valid]
+    v = np.broadcast_to(nodes[tries][:, :, None, :], pair_valid.shape)[pair_valid]
+
+    # Edges can be traversed in either direction.
+    e = find_edges(u, v)
+    backwards = e < 0
+    e[backwards] = find_edges(v[backwards], u[backwards])
+
+    edge = np.full(pair_valid.shape, -1, dtype=np.int64)
+    edge[pair_valid] = e
+    hit = edge >= 0
+
+    # Only the first try that completes an edge counts, but it can complete several.
+    try_hit = hit.any(axis=(2, 3))
+    first_try = np.argmax(try_hit, axis=1)
+    hit &= (np.arange(max_tries) == first_try[:, None])[:, :, None, None]
+
+    s, t, a, b = np.nonzero(hit)
+    completed_edges.append(edge[s, t, a, b])
+    completed_start.append(block[s])
+    settled.append(try_hit.any(axis=1) | try_valid.all(axis=1))
+
+  if not completed_edges:
+    return np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64), np.empty(0, dtype=bool)
+
+  return np.concatenate(completed_edges), np.concatenate(completed_start), np.concatenate(settled)
+
+
+def match_points_to_edges(points, nodes_df, edges_df, kdtree, max_node_dist=40, edge_index=None):
   """
   Matches a sequence of GPS coordinates to edges the street graph. This allows
   us to figure out which edges have been completed.
 
   Args:
     points (np.ndarray) : 2D array of [lng, lat] coordinates.
-    nodes_df (GeoDataFrame) : dataframe with network nodes.
-    edges_df (GeoDataFrame) : dataframe with network edges.
-    kdtree (ktree) : a KDtree for quick nearest neighbor lookups.
-    max_node_dist (float) : maximum distance for matching a point to a node.
+    nodes_df (GeoDataFrame or MatchGraph) : dataframe with network nodes, or a MatchGraph.
+    edges_df (GeoDataFrame) : dataframe with network edges (unused with a MatchGraph).
+    kdtree (ktree) : a KDtree for quick nearest neighbor lookups, from kdtree_from_gdf.
+    max_node_dist (float) : maximum distance for matching a point to a node, in meters.
+    edge_index (dict) : optional (u, v) lookup from edge_index_from_gdf(edges_df).
+      Pass this in when matching many activities against the same graph.
 
   Returns:
-    (GeoDataFrame) with completed edges
+    (GeoDataFrame) with completed edges, or (np.ndarray) of completed edge
+    indices if nodes_df is a MatchGraph. See edge_records().
 
   References:
    - https://gis.stackexchange.com/questions/222315/finding-nearest-point-in-other-geodataframe-using-geopandas
   """
-  # Get points from matched activity.
-  dists, idxs = kdtree.query(points, k=3)
-
-  # Get distance between each point and neighbor in meters.
-  # https://gis.stackexchange.com/questions/293310/how-to-use-geoseries-distance-to-get-the-right-answer/293319
-  query_gdf = gpd.GeoDataFrame(geometry=[Point(p) for p in points], crs='EPSG:4326')
-  query_gdf.to_crs(epsg=3310, inplace=True)
-
-  nn0 = nodes_df.iloc[idxs[:,0]].to_crs(epsg=3310).reset_index(drop=True)
-  nn1 = nodes_df.iloc[idxs[:,1]].to_crs(epsg=3310).reset_index(drop=True)
-  nn2 = nodes_df.iloc[idxs[:,2]].to_crs(epsg=3310).reset_index(drop=True)
-
-  # Put nearest neighbor nodes and distances in one df.
-  nn_data = pd.concat(
-    [
-      pd.Series(nodes_df.iloc[idxs[:,0]].reset_index(drop=False)['osmid'], name='osmid0', dtype=np.int64),
-      pd.Series(nodes_df.iloc[idxs[:,1]].reset_index(drop=False)['osmid'], name='osmid1', dtype=np.int64),
-      pd.Series(nodes_df.iloc[idxs[:,2]].reset_index(drop=False)['osmid'], name='osmid2', dtype=np.int64),
-      pd.Series(query_gdf.distance(nn0), name='dist0'),
-      pd.Series(query_gdf.distance(nn1), name='dist1'),
-      pd.Series(query_gdf.distance(nn2), name='dist2')
-    ],
-    axis=1)
+  # Project points the same way as the KDtree, so that distances are in meters.
+  if isinstance(nodes_df, MatchGraph):
+    query_xy = nodes_df.project(points)
+  else:
+    lnglat = shapely.get_coordinates(nodes_df.geometry.values)
+    query_xy = project_points(local_transformer(*bbox_center(lnglat).tolist()), points)
 
-  completed_edges = []
-  # Put nearest neighbor nodes and distances in one df.
-  nn_data = pd.concat(
-    [
-      pd.Series(nodes_df.iloc[idxs[:,0]].reset_index(drop=False)['osmid'], name='osmid0', dtype=np.int64),
-      pd.Series(nodes_df.iloc[idxs[:,1]].reset_index(drop=False)['osmid'], name='osmid1', dtype=np.int64),
-      pd.Series(nodes_df.iloc[idxs[:,2]].reset_index(drop=False)['osmid'], name='osmid2', dtype=np.int64),
-      pd.Series(dists[:,0], name='dist0'),
-      pd.Series(dists[:,1], name='dist1'),
-      pd.Series(dists[:,2], name='dist2')
-    ],
-    axis=1)
+  # Get the nearest neighbor nodes for each point.
+  with metrics.span('matching.kdtree_query'):
+    dists, idxs = kdtree.query(query_xy, k=3)
 
-  completed_edges = []
+  if isinstance(nodes_df, MatchGraph):
+    edges, _ = match_node_candidates(idxs, dists, nodes_df.find_edges, max_node_dist=max_node_dist)
+    return edges
+
+  if edge_index is None:
+    edge_index = edge_index_from_gdf(edges_df)
+
+  osmids = nodes_df.index.to_numpy(dtype=np.int64)[idxs]
+
+  rows, _ = match_node_candidates(osmids, dists, edge_finder_from_index(edge_index), max_node_dist=max_node_dist)
+
+  return edges_df.iloc[rows]
+
+
+@metrics.timed('matching.resample')
+def resample_activities(activities, graph, spacing):
+  """
+  Project and resample many activities at once, without bridging the gap
+  between consecutive activities.
+
+  Returns:
+    (tuple) of the resampled points in the graph's projection (float64[M, 2]),
+    and int64[A+1] offsets splitting them up by activity.
+  """
+  arrays = [np.asarray(a, dtype=np.float64).reshape(-1, 2) for a in activities]
+  lengths = np.array([len(a) for a in arrays], dtype=np.int64)
+  if lengths.sum() == 0:
+    return np.empty((0, 2), dtype=np.float64), np.zeros(len(arrays) + 1, dtype=np.int64)
+
+  offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+  np.cumsum(lengths, out=offsets[1:])
+
+  xy = graph.project(np.concatenate(arrays))
+
+  # Don't resample the segments that join the end of one activity to the start of the next.
+  keep = np.ones(len(xy) - 1, dtype=bool)
+  joins = offsets[1:-1] - 1
+  keep[joins[(joins >= 0) & (joins < len(keep))]] = False
+  seg, k, counts = densify_segments(xy, spacing, keep=keep)
+
+  step = (xy[1:] - xy[:-1]) / counts[:, None]
+  query_xy = k[:, None] * step[seg] + xy[seg]
+
+  # Each activity's resampled points are contiguous, since seg is sorted.
+  activity_of_point = np.repeat(np.arange(len(arrays)), lengths)
+  query_offsets = np.zeros(len(arrays) + 1, dtype=np.int64)
+  np.cumsum(np.bincount(activity_of_point[seg], minlength=len(arrays)), out=query_offsets[1:])
+
+  return query_xy, query_offsets
+
+
+def match_activities_batch(activities, graph, spacing=15.0, max_node_dist=30):
+  """
+  Resample and match many activities against the same graph in one go.
+
+  All of the points are projected together, resampled together (without
+  bridging the gap between consecutive activities), looked up in the KDtree
+  with a single query and matched with a single call.
+
+  Args:
+    activities (list) : one list or (N, 2) array of [lng, lat] coordinates per activity.
+    graph (MatchGraph) : the graph to match against.
+    spacing (float) : Maximum distance between resampled points in meters.
+    max_node_dist (float) : maximum distance for matching a point to a node, in meters.
+
+  Returns:
+    (list) with an np.ndarray of completed edge indices for each activity, the
+    same as match_points_to_edges() returns for a MatchGraph.
+  """
+  query_xy, query_offsets = resample_activities(activities, graph, spacing)
+  if len(query_xy) == 0:
+    return [np.empty(0, dtype=np.int64) for _ in activities]
 
-  for i in range(len(points) - 1):
-    di_values = [nn_data.iloc[i]['dist{}'.format(_)] for _ in range(3)]
-    di_valid = [di < max_node_dist for di in di_values]
+  with metrics.span('matching.kdtree_query'):
+    dists, idxs = graph.kdtree.query(query_xy, k=3)
 
-    # Check if starting point i is near a node. If not, skip.
-    # By definition, all other candidates will be farther.
-    if not di_valid[0]:
+  edges, edge_offsets = match_node_candidates(idxs, dists, graph.find_edges, max_node_dist=max_node_dist,
+                                              offsets=query_offsets)
+
+  return np.split(edges, edge_offsets[1:-1])
+
+
+def match_points_stream(point_chunks, graph, spacing=15.0, max_node_dist=30, max_tries=10):
+  """
+  Match a single activity that arrives in chunks, yielding edges as soon as
+  they're completed.
+
+  Gives the same edges, in the same order, as match_activities_batch() on the
+  whole activity, but memory is bounded by the chunk size rather than the
+  length of the activity. Between chunks, the only state kept is:
+    - the last raw point, so the segment across the chunk boundary is resampled.
+    - the near-node points from the earliest start that isn't settled yet. A
+      start is settled once it has completed an edge or seen all max_tries of
+      its tries, so there are at most max_tries of these.
+    - the last two resampled points, since the end of an activity has its own
+      rules and the last point isn't known until the chunks run out.
+
+  Args:
+    point_chunks (iterable) : lists or (N, 2) arrays of [lng, lat] coordinates, in order.
+    graph (MatchGraph) : the graph to match against.
+    spacing (float) : Maximum distance between resampled points in meters.
+    max_node_dist (float) : maximum distance for matching a point to a node, in meters.
+    max_tries (int) : number of later node matches to try for each starting point.
+
+  Yields:
+    (int) completed edge indices.
+  """
+  carry = np.empty((0, 2), dtype=np.float64)
+  nodes = np.empty((0, 3), dtype=np.int64)
+  dists = np.empty((0, 3), dtype=np.float64)
+  rows = np.empty(0, dtype=np.int64)  # Position of each buffered point in the whole activity.
+  num_points = 0
+  next_start = 0
+
+  for chunk in point_chunks:
+    xy = np.concatenate([carry, graph.project(np.asarray(chunk, dtype=np.float64).reshape(-1, 2))])
+    if len(xy) < 2:
+      carry = xy
       continue
 
-    j = i + 1
-    did_complete_edge = False     # Once we complete an edge that starts from this node, continue.
-    tries_remaining = 10          # Far away node matches are unlikely to complete an edge.
-    while j < (len(points) - 1) and not did_complete_edge and tries_remaining > 0:
-
-      # Search for the next end point j that's near a node.
-      while (j < (len(points) - 1) and nn_data.iloc[j]['dist0'] > max_node_dist):
-        j += 1
-
-      # Handle the case where we reach the last point.
-      dj = nn_data.iloc[j]['dist0']
-      if dj > max_node_dist:
-        continue
-
-      # Get the candidate node IDs of i and j.
-      u_options = [np.int64(nn_data.iloc[i]['osmid{}'.format(_)]) for _ in range(3) if di_valid[_]]
-      v_options = [np.int64(nn_data.iloc[j]['osmid{}'.format(_)]) for _ in range(3) if di_valid[_]]
-
-      for u in u_options:
-        for v in v_options:
-          uv_exists = edges_df.index.isin([(u, v, 0)]).any()
-          vu_exists = edges_df.index.isin([(v, u, 0)]).any()
-
-          if uv_exists:
-            e = edges_df.loc[(u, v, 0)]
-            completed_edges.append(e)
-            did_complete_edge = True
-          elif vu_exists:
-            e = edges_df.loc[(v, u, 0)]
-            completed_edges.append(e)
-            did_complete_edge = True
-
-      j += 1
-      tries_remaining -= 1
-
-  return gpd.GeoDataFrame(data=completed_edges)
+    # The final point gets resampled with the next chunk (or dropped, like resample_points does).
+    seg, k, counts = densify_segments(xy, spacing)
+    step = (xy[1:] - xy[:-1]) / counts[:, None]
+    d, i = graph.kdtree.query(k[:, None] * step[seg] + xy[seg], k=3)
+    carry = xy[-1:]
+
+    nodes = np.concatenate([nodes, i])
+    dists = np.concatenate([dists, d])
+    rows = np.concatenate([rows, np.arange(num_points, num_points + len(d))])
+    num_points += len(d)
+
+    # Every point but the last is known not to be the end of the activity.
+    known = len(rows) - 1
+    candidates = np.flatnonzero(dists[:known, 0] <= max_node_dist)
+    starts = np.flatnonzero((dists[:known, 0] < max_node_dist) & (rows[:known] >= next_start))
+    edges, edge_start, settled = _complete_edges(nodes, dists, candidates, starts, np.zeros(len(rows), dtype=np.int64),
+                                                 graph.find_edges, max_node_dist, max_tries, block_size=20000)
+
+    # Hand out edges up to the first start that could still be completed by later points.
+    unsettled = starts[~settled]
+    first = unsettled[0] if len(unsettled) > 0 else known
+    for e in edges[edge_start < first]:
+      yield int(e)
+    next_start = rows[first]
+
+    # Drop everything that can't be a start or a try any more.
+    keep = (rows >= next_start) & (dists[:, 0] <= max_node_dist)
+    keep[-2:] = True
+    nodes, dists, rows = nodes[keep], dists[keep], rows[keep]
+
+  if num_points == 0:
+    return
+
+  # Now the end of the activity is known, apply the same rules as match_node_candidates().
+  is_last = rows == num_points - 1
+  near = (dists[:, 0] <= max_node_dist) & ~is_last
+  prev_near = near[-2] if len(rows) > 1 and rows[-2] == num_points - 2 else False
+  candidates = np.flatnonzero(near | (is_last & (dists[:, 0] <= max_node_dist) & ~prev_near))
+  starts = np.flatnonzero((dists[:, 0] < max_node_dist) & ~is_last & (rows != num_points - 2) & (rows >= next_start))
+  edges, _, _ = _complete_edges(nodes, dists, candidates, starts, np.zeros(len(rows), dtype=np.int64),
+                                graph.find_edges, max_node_dist, max_tries, block_size=20000)
+  for e in edges:
+    yield int(e)
+
+
+def match_activities_by_segments(activities, graph, spacing=40.0, max_dist=20.0, min_coverage=0.5):
+  """
+  Match activities by their distance to edge geometries, instead of to nodes.
+
+  Each resampled point is matched to every edge within max_dist of it (see
+  SegmentIndex). When two consecutive points are both near the same edge, the
+  stretch of the edge between their closest points counts as covered. An edge
+  is completed once its covered length reaches whichever is larger: all but
+  max_dist at each end, or min_coverage of the edge. Since the whole track is
+  projected onto the edges, the points can be a lot sparser than with the node
+  matcher.
+
+  Args:
+    activities (list) : one list or (N, 2) array of [lng, lat] coordinates per activity.
+    graph (MatchGraph) : the graph to match against.
+    spacing (float) : Maximum distance between resampled points in meters.
+    max_dist (float) : maximum distance from a point to an edge, in meters.
+    min_coverage (float) : fraction of an edge that must be covered, however short it is.
+
+  Returns:
+    (list) with an np.ndarray of completed edge indices for each activity, in
+    increasing order.
+  """
+  no_edges = [np.empty(0, dtype=np.int64) for _ in activities]
+
+  query_xy, query_offsets = resample_activities(activities, graph, spacing)
+  with metrics.span('matching.segment_query'):
+    point, edge, _, along = graph.segment_index.query(query_xy, max_dist)
+
+  # Find pairs of consecutive points (in the same activity) that are near the same edge.
+  activity = np.repeat(np.arange(len(activities)), np.diff(query_offsets))
+  # With a stride of one more than the number of points, keys + 1 never runs into the next edge.
+  keys = edge * (len(query_xy) + 1) + point
+  order = np.argsort(keys)
+  nxt = order[np.minimum(np.searchsorted(keys[order], keys + 1), max(len(keys) - 1, 0))]
+  paired = (keys[nxt] == keys + 1) if len(keys) > 0 else np.zeros(0, dtype=bool)
+  paired[paired] &= activity[point[paired]] == activity[point[paired] + 1]
+  if not paired.any():
+    return no_edges
+  nxt = nxt[paired]
+
+  # Each pair covers an interval along the edge. Add up the length of their union for every (activity, edge).
+  start = np.minimum(along[paired], along[nxt])
+  end = np.maximum(along[paired], along[nxt])
+  groups, group = np.unique(activity[point[paired]] * graph.num_edges + edge[paired], return_inverse=True)
+
+  # Shift each group into its own range, so that a single running max works across all of them.
+  shift = group * (graph.segment_index.edge_length_m.max() + 1.0)
+  order = np.lexsort((start, group))
+  group, start, end = group[order], start[order] + shift[order], end[order] + shift[order]
+  reach = np.concatenate(([-np.inf], np.maximum.accumulate(end)[:-1]))
+  covered = np.bincount(group, weights=np.maximum(0.0, end - np.maximum(start, reach)), minlength=len(groups))
+
+  length = graph.segment_index.edge_length_m[groups % graph.num_edges]
+  required = np.maximum(length - 2 * max_dist, min_coverage * length)
+  done = groups[covered >= required]
+
+  edge_offsets = np.zeros(len(activities) + 1, dtype=np.int64)
+  np.cumsum(np.bincount(done // graph.num_edges, minlength=len(activities)), out=edge_offsets[1:])
+  return np.split((done % graph.num_edges).astype(np.int64), edge_offsets[1:-1])
+
+
+# Bulk matchers that can be picked by name. Each one takes (activities, graph, **kwargs).
+MATCHERS = {
+  'nodes': match_activities_batch,
+  'segments': match_activities_by_segments
+}
+
+
+def match_activities_tiled(activities, tiled, method='nodes', margin=50.0, **kwargs):
+  """
+  Match activities against a TiledGraph, loading only the tiles around each one.
+
+  Activities that need the same tiles are matched together, on a MatchGraph
+  made from just those tiles, which hold every node and edge within margin of
+  the activity. With margin at least max_dist, the segments method gives the
+  same matches as on the whole graph, since it only looks at edges within
+  max_dist of the points. The nodes method only starts edges from nodes within
+  max_node_dist, but it also tries the end point's farther nearest nodes (see
+  match_node_candidates), so it can differ when one of those is beyond margin.
+
+  Args:
+    activities (list) : one list or (N, 2) array of [lng, lat] coordinates per activity.
+    tiled (TiledGraph) : the graph to match against.
+    method (str) : which of MATCHERS to use.
+    margin (float) : distance around each activity to load, in meters.
+    kwargs : passed on to the matcher (e.g. spacing).
+
+  Returns:
+    (list) with an np.ndarray of completed edge indices in the whole graph for each activity.
+  """
+  groups = {}
+  for i, points in enumerate(activities):
+    names = tuple(tiled.tiles_for(tiled.project(points), margin))
+    if names:
+      groups.setdefault(names, []).append(i)
+
+  matched = [np.empty(0, dtype=np.int64) for _ in activities]
+  for names, idx in groups.items():
+    graph, edge_global = tiled.subgraph(names)
+    for i, edges in zip(idx, MATCHERS[method]([activities[i] for i in idx], graph, **kwargs)):
+      matched[i] = np.asarray(edge_global[edges], dtype=np.int64)
+
+  return matched
+
+
+@metrics.timed('matching.edge_records')
+def edge_records(graph, edge_idx):
+  """
+  Get the id, GeoJSON geometry and length of matched edges for storage.
+
+  These are all serialized when the graph is built (see MatchGraph), so this is
+  just a gather plus a single json.loads for all of the geometries.
+
+  Args:
+    graph (MatchGraph) : the graph that edges were matched against.
+    edge_idx (np.ndarray) : edge indices from match_points_to_edges.
+
+  Returns:
+    (tuple) of edge id strings, GeoJSON LineString dicts and lengths in meters.
+  """
+  edge_idx = np.asarray(edge_idx, dtype=np.int64)
+  return graph.edge_ids(edge_idx), json.loads(graph.edge_geojson(edge_idx)), graph.edge_length[edge_idx].tolist()
@@ -0,0 +1,174 @@
+from contextlib import contextmanager
+import contextvars
+import functools
+import threading
+import time
+
+
+# Upper bounds (in seconds) of the latency histogram buckets.
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+# The per-request breakdown that spans add to, if one is being collected (see collect_timings).
+_timings = contextvars.ContextVar('timings', default=None)
+# Spans on other threads (see python/pipeline.py) can add to the same breakdown.
+_timings_lock = threading.Lock()
+
+
+class StageMetrics(object):
+  """
+  Process-wide latency histograms and error counters for named stages, in a
+  form that can be rendered as Prometheus text.
+  """
+  def __init__(self, buckets=BUCKETS):
+    self.buckets = buckets
+    self._lock = threading.Lock()
+    self._stages = {}
+
+  def observe(self, stage, seconds, error=False):
+    with self._lock:
+      s = self._stages.get(stage)
+      if s is None:
+        s = self._stages[stage] = {'buckets': [0] * len(self.buckets), 'count': 0, 'sum': 0.0, 'errors': 0}
+      for i, le in enumerate(self.buckets):
+        if seconds <= le:
+          s['buckets'][i] += 1
+      s['count'] += 1
+      s['sum'] += seconds
+      s['errors'] += int(error)
+
+  def clear(self):
+    with self._lock:
+      self._stages.clear()
+
+  def render(self):
+    """
+    Get all of the metrics in the Prometheus text exposition format.
+    """
+    with self._lock:
+      stages = {name: dict(s, buckets=list(s['buckets'])) for name, s in sorted(self._stages.items())}
+
+    lines = [
+      '# HELP everystreet_stage_duration_seconds Time spent in each stage.',
+      '# TYPE everystreet_stage_duration_seconds histogram',
+    ]
+    for name, s in stages.items():
+      for le, count in zip(self.buckets, s['buckets']):
+        lines.append('everystreet_stage_duration_seconds_bucket{{stage="{}",le="{}"}} {}'.format(name, le, count))
+      lines.append('everystreet_stage_duration_seconds_bucket{{stage="{}",le="+Inf"}} {}'.format(name, s['count']))
+      lines.append('everystreet_stage_duration_seconds_sum{{stage="{}"}} {}'.format(name, s['sum']))
+      lines.append('everystreet_stage_duration_seconds_count{{stage="{}"}} {}'.format(name, s['count']))
+
+    lines.append('# HELP everystreet_stage_calls_total Number of times each stage ran.')
+    lines.append('# TYPE everystreet_stage_calls_total counter')
+    for name, s in stages.items():
+      lines.append('everystreet_stage_calls_total{{stage="{}"}} {}'.format(name, s['count']))
+
+    lines.append('# HELP everystreet_stage_errors_total Number of times each stage raised an exception.')
+    lines.append('# TYPE everystreet_stage_errors_total counter')
+    for name, s in stages.items():
+      lines.append('everystreet_stage_errors_total{{stage="{}"}} {}'.format(name, s['errors']))
+
+    return '\n'.join(lines) + '\n'
+
+
+STAGES = StageMetrics()
+
+
+def record(stage, seconds, error=False):
+  """
+  Record a stage that took some number of seconds, in the process-wide
+  histograms and the current request's breakdown (if there is one).
+  """
+  STAGES.observe(stage, seconds, error=error)
+  timings = _timings.get()
+  if timings is not None:
+    with _timings_lock:
+      timings[stage] = timings.get(stage, 0.0) + seconds
+
+
+@contextmanager
+def span(stage):
+  """
+  Time the code inside a with block as stage.
+  """
+  t0 = time.perf_counter()
+  error = False
+  try:
+    yield
+  except BaseException:
+    error = True
+    raise
+  finally:
+    record(stage, time.perf_counter() - t0, error=error)
+
+
+def timed(stage):
+  """
+  Decorator that times every call to a function as stage.
+  """
+  def decorator(func):
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+      with span(stage):
+        return func(*args, **kwargs)
+    return wrapper
+  return decorator
+
+
+def timed_iter(stage, iterable):
+  """
+  Iterate over iterable, timing how long each item takes to come back as
+  stage. Useful for generators that do their work lazily (or wait on other
+  processes) between items.
+  """
+  it = iter(iterable)
+  while True:
+    with span(stage):
+      try:
+        item = next(it)
+      except StopIteration:
+        return
+    yield item
+
+
+def start_timings():
+  """
+  Start collecting a breakdown of the time spent in each stage (in this
+  thread), until stop_timings() is called.
+
+  Returns:
+    (dict) of stage name to total seconds, filled in as spans finish.
+  """
+  timings = {}
+  _timings.set(timings)
+  return timings
+
+
+def stop_timings():
+  _timings.set(None)
+
+
+@contextmanager
+def collect_timings():
+  """
+  Collect a breakdown of the time spent in each stage inside a with block.
+  Yields the dict from start_timings(). Spans can be nested, so stages can
+  overlap (e.g. 'graph.load' happens inside 'graph.get').
+  """
+  previous = _timings.get()
+  timings = start_timings()
+  try:
+    yield timings
+  finally:
+    _timings.set(previous)
+
+
+def timings_ms(timings):
+  """
+  Round a breakdown from collect_timings to milliseconds, for responses.
+  """
+  return {stage: round(1e3 * seconds, 2) for stage, seconds in sorted(timings.items())}
+
+
+def render_prometheus():
+  return STAGES.render()
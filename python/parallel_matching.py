@@ -0,0 +1,189 @@
+from collections import deque
+import multiprocessing
+import os
+
+import numpy as np
+
+from python.map_boundary import clip_activities
+import python.matching as matching
+
+
+# Set in each worker process by _init_worker.
+_WORKER_GRAPH = None
+_WORKER_BOUNDARY = None
+
+
+def default_workers():
+  """
+  Number of matching processes to use, from the MATCH_WORKERS environment variable.
+  """
+  return max(1, int(os.getenv('MATCH_WORKERS', 1)))
+
+
+def _init_worker(graph_file, boundary=None):
+  global _WORKER_GRAPH, _WORKER_BOUNDARY
+  # The arrays are memory mapped from the binary cache, so every worker shares the same pages.
+  _WORKER_GRAPH = matching.load_match_graph(graph_file)
+  _WORKER_BOUNDARY = boundary
+
+
+def _match_chunk(args):
+  start, activities, method, kwargs = args
+  return start, matching.MATCHERS[method](activities, _WORKER_GRAPH, **kwargs)
+
+
+def match_activities_parallel(activities, graph_file, workers=None, graph=None, chunk_size=32, method='nodes',
+                              boundary=None, **kwargs):
+  """
+  Match activities on a pool of processes, and yield the results as they come
+  back so that a single caller can write them out.
+
+  Workers don't get a pickled copy of the graph. Each one opens the graph's
+  binary cache (see matching.load_match_graph) read-only, so the arrays are
+  shared between processes through the page cache. Only the activity
+  coordinates and the matched edge indices are sent between processes.
+
+  Args:
+    activities (list) : one list or (N, 2) array of [lng, lat] coordinates per activity.
+    graph_file (str) : path to the map's GeoPackage.
+    workers (int) : number of processes. Defaults to default_workers(). With 1,
+      everything runs in this process.
+    graph (MatchGraph) : optional, already loaded graph to use when running in this process.
+    chunk_size (int) : number of activities sent to a worker at a time.
+    method (str) : which of matching.MATCHERS to use.
+    boundary (MapBoundary) : optional map boundary. Activities are clipped to it
+      before matching, and the ones that never enter it aren't matched at all.
+    kwargs : passed on to the matcher (e.g. spacing).
+
+  Yields:
+    (tuple) of the activity's position in activities, and its matched edge indices.
+    Every activity is yielded, including the ones outside the boundary.
+  """
+  if boundary is not None:
+    yield from _match_clipped(activities, boundary, graph_file, workers=workers, graph=graph,
+                              chunk_size=chunk_size, method=method, **kwargs)
+    return
+
+  if workers is None:
+    workers = default_workers()
+
+  chunks = [(i, activities[i:i+chunk_size], method, kwargs) for i in range(0, len(activities), chunk_size)]
+
+  if workers <= 1 or len(chunks) <= 1:
+    if graph is None:
+      graph = matching.load_match_graph(graph_file)
+    for start, chunk, _, _ in chunks:
+      for i, edges in enumerate(matching.MATCHERS[method](chunk, graph, **kwargs)):
+        yield start + i, edges
+    return
+
+  # Make sure the cache is up to date before the workers race to open it.
+  matching.load_match_graph(graph_file)
+
+  with multiprocessing.Pool(processes=min(workers, len(chunks)), initializer=_init_worker,
+                            initargs=(graph_file,)) as pool:
+    for start, matched in pool.imap_unordered(_match_chunk, chunks):
+      for i, edges in enumerate(matched):
+        yield start + i, edges
+
+
+def _match_clipped(activities, boundary, graph_file, **kwargs):
+  """
+  Match the parts of each activity that are inside boundary, and put the
+  edges from each activity's runs back together (in order).
+  """
+  runs, owner = clip_activities(activities, boundary)
+  remaining = np.bincount(owner, minlength=len(activities))
+
+  # Nothing to match for these, but they still count as processed.
+  for i in np.flatnonzero(remaining == 0):
+    yield int(i), np.empty(0, dtype=np.int64)
+
+  parts = {}
+  for r, edges in match_activities_parallel(runs, graph_file, **kwargs):
+    i = int(owner[r])
+    parts.setdefault(i, []).append((r, edges))
+    remaining[i] -= 1
+    if remaining[i] == 0:
+      yield i, np.concatenate([edges for _, edges in sorted(parts.pop(i), key=lambda p: p[0])])
+
+
+def _match_keyed(chunk, graph, method, boundary, kwargs):
+  """
+  Match a chunk of (key, coordinates) in this process.
+
+  Returns:
+    (list) of (key, matched edge indices), in the same order as chunk.
+  """
+  matched = dict(match_activities_parallel([coords for _, coords in chunk], None, workers=1, graph=graph,
+                                           chunk_size=len(chunk), method=method, boundary=boundary, **kwargs))
+  return [(key, matched[i]) for i, (key, _) in enumerate(chunk)]
+
+
+def _match_keyed_chunk(args):
+  chunk, method, kwargs = args
+  return _match_keyed(chunk, _WORKER_GRAPH, method, _WORKER_BOUNDARY, kwargs)
+
+
+def _chunked(items, size):
+  chunk = []
+  for item in items:
+    chunk.append(item)
+    if len(chunk) == size:
+      yield chunk
+      chunk = []
+  if chunk:
+    yield chunk
+
+
+def match_activity_stream(activities, graph_file, workers=None, graph=None, chunk_size=32, method='nodes',
+                          boundary=None, max_chunks=None, **kwargs):
+  """
+  Like match_activities_parallel, but for activities that arrive one at a
+  time (e.g. while they're still being read from the database, see
+  python/pipeline.py). A chunk is matched as soon as it's full, so matching
+  starts before the last activity has arrived.
+
+  Args:
+    activities (iterable) : (key, coordinates) for each activity, where the
+      coordinates are a list or (N, 2) array of [lng, lat].
+    graph_file (str) : path to the map's GeoPackage.
+    workers (int) : number of processes. Defaults to default_workers(). With 1,
+      everything runs in this process, and each activity is matched (and
+      yielded) as soon as it arrives.
+    graph (MatchGraph) : optional, already loaded graph to use when running in this process.
+    chunk_size (int) : number of activities sent to a worker at a time.
+    method (str) : which of matching.MATCHERS to use.
+    boundary (MapBoundary) : optional map boundary (see match_activities_parallel).
+    max_chunks (int) : maximum number of chunks waiting for a worker or
+      being matched, which bounds how far reading can get ahead of matching.
+      Defaults to twice the number of workers.
+    kwargs : passed on to the matcher (e.g. spacing).
+
+  Yields:
+    (tuple) of the activity's key and its matched edge indices, in the order the activities came in.
+  """
+  if workers is None:
+    workers = default_workers()
+
+  if workers <= 1:
+    if graph is None:
+      graph = matching.load_match_graph(graph_file)
+    for key, coords in activities:
+      yield from _match_keyed([(key, coords)], graph, method, boundary, kwargs)
+    return
+
+  if max_chunks is None:
+    max_chunks = 2 * workers
+
+  # Make sure the cache is up to date before the workers race to open it.
+  matching.load_match_graph(graph_file)
+
+  with multiprocessing.Pool(processes=workers, initializer=_init_worker, initargs=(graph_file, boundary)) as pool:
+    pending = deque()
+    for chunk in _chunked(activities, chunk_size):
+      pending.append(pool.apply_async(_match_keyed_chunk, ((chunk, method, kwargs),)))
+      if len(pending) >= max_chunks:
+        yield from pending.popleft().get()
+    while pending:
+      yield from pending.popleft().get()
@@ -0,0 +1,199 @@
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import os
+import queue
+import threading
+
+import python.metrics as metrics
+import python.parallel_matching as parallel_matching
+
+
+def default_prefetch():
+  """
+  Number of activities to read ahead of matching, from the MATCH_PREFETCH environment variable.
+  """
+  return max(0, int(os.getenv('MATCH_PREFETCH', 32)))
+
+
+def default_write_queue():
+  """
+  Number of matched activities that can wait to be written, from the MATCH_WRITE_QUEUE environment variable.
+  """
+  return max(0, int(os.getenv('MATCH_WRITE_QUEUE', 64)))
+
+
+def prefetch(fetch, keys, depth=32, threads=8):
+  """
+  Call fetch(key) for each of keys on a pool of threads, and yield the results
+  in the same order as keys.
+
+  Up to depth results are read ahead, whether or not anything has asked for
+  them yet, so slow reads (e.g. round trips to the database) happen while the
+  caller is busy with the results it already has.
+
+  Args:
+    fetch (callable) : called with each key.
+    keys (iterable) : the keys to fetch.
+    depth (int) : maximum number of results that are being fetched or waiting
+      to be yielded. With 0, everything is fetched in this thread, one at a time.
+    threads (int) : maximum number of fetches at once.
+
+  Yields:
+    (tuple) of each key and fetch(key). If fetch raises, the exception is
+    raised here when its result would have been yielded.
+  """
+  if depth <= 0:
+    for key in keys:
+      yield key, fetch(key)
+    return
+
+  slots = threading.Semaphore(depth)
+  futures = queue.Queue()
+  stop = threading.Event()
+  pool = ThreadPoolExecutor(max_workers=max(1, min(threads, depth)))
+  # Reads run in copies of this context, so they're timed as part of the request (see metrics.py).
+  context = contextvars.copy_context()
+
+  def feed():
+    try:
+      for key in keys:
+        slots.acquire()
+        if stop.is_set():
+          return
+        futures.put((key, pool.submit(context.copy().run, fetch, key)))
+    finally:
+      futures.put(None)
+
+  feeder = threading.Thread(target=feed, daemon=True)
+  feeder.start()
+
+  try:
+    while True:
+      item = futures.get()
+      if item is None:
+        return
+      key, future = item
+      result = future.result()
+      slots.release()
+      yield key, result
+  finally:
+    stop.set()
+    slots.release() # In case the feeder is waiting for a slot.
+    # Cancel the reads nobody will ask for (shutdown's cancel_futures needs Python 3.9, see runtime.txt).
+    while True:
+      try:
+        item = futures.get_nowait()
+      except queue.Empty:
+        break
+      if item is not None:
+        item[1].cancel()
+    pool.shutdown(wait=False)
+
+
+# Tells the writer thread to stop.
+_DONE = object()
+
+
+class WriteBehind(object):
+  """
+  Calls write(*args) for everything that's put in it, in order, on a
+  background thread, so that a slow write doesn't hold up the caller.
+
+  Up to depth calls can wait to run. After that, put blocks until there's
+  room. If a write raises, the rest are skipped and the exception is raised
+  from the next put (or close).
+
+  Usage:
+    with WriteBehind(writer.add, depth=64) as writes:
+      for activity_id, edge_idx in results:
+        writes.put(activity_id, edge_idx)
+  """
+  def __init__(self, write, depth=64):
+    """
+    Args:
+      write (callable) : called with the arguments to each put.
+      depth (int) : maximum number of calls waiting to run. With 0, put calls
+        write right away, in this thread.
+    """
+    self.write = write
+    self.depth = depth
+    self._error = None
+    self._thread = None
+
+    if depth > 0:
+      self._queue = queue.Queue(maxsize=depth)
+      self._thread = threading.Thread(target=self._run, args=(contextvars.copy_context(),), daemon=True)
+      self._thread.start()
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, exc_type, *args):
+    self.close(raise_error=exc_type is None)
+
+  def _run(self, context):
+    while True:
+      args = self._queue.get()
+      if args is _DONE:
+        return
+      if self._error is None:
+        try:
+          context.run(self.write, *args)
+        except Exception as e:
+          self._error = e
+
+  def put(self, *args):
+    if self._thread is None:
+      self.write(*args)
+      return
+    if self._error is not None:
+      raise self._error
+    self._queue.put(args)
+
+  def close(self, raise_error=True):
+    """
+    Wait for all of the writes to finish.
+    """
+    if self._thread is None:
+      return
+    self._queue.put(_DONE)
+    self._thread.join()
+    self._thread = None
+    if raise_error and self._error is not None:
+      raise self._error
+
+
+def match_and_write(fetch, keys, write, graph_file, prefetch_depth=None, write_queue=None, **kwargs):
+  """
+  Read, match and write out activities as a pipeline, with each stage running
+  at the same time as the others:
+
+    fetch (threads, see prefetch) -> match (this process, or a pool of
+    processes, see parallel_matching.match_activity_stream) -> write (a
+    thread, see WriteBehind)
+
+  With prefetch_depth and write_queue both 0, this reads, matches and writes
+  one step at a time in this thread.
+
+  Args:
+    fetch (callable) : gets the [lng, lat] coordinates of the activity with a key.
+    keys (iterable) : keys of the activities to match.
+    write (callable) : called with each key and its matched edge indices.
+    graph_file (str) : path to the map's GeoPackage.
+    prefetch_depth (int) : number of activities to read ahead of matching.
+      Defaults to default_prefetch().
+    write_queue (int) : number of matched activities that can wait to be
+      written. Defaults to default_write_queue().
+    kwargs : passed on to parallel_matching.match_activity_stream (e.g. workers, graph, method).
+  """
+  if prefetch_depth is None:
+    prefetch_depth = default_prefetch()
+  if write_queue is None:
+    write_queue = default_write_queue()
+
+  fetched = prefetch(fetch, keys, depth=prefetch_depth)
+  with WriteBehind(write, depth=write_queue) as writes:
+    # Time spent waiting on the matcher (and the reads ahead of it).
+    for key, edges in metrics.timed_iter('matching.results',
+                                         parallel_matching.match_activity_stream(fetched, graph_file, **kwargs)):
+      writes.put(key, edges)
@@ -0,0 +1,120 @@
+import numpy as np
+
+
+class SegmentIndex(object):
+  """
+  Uniform grid over the straight segments that make up every edge geometry, for
+  finding the edges near a point by true point-to-segment distance.
+
+  Each segment is stored in every grid cell that its bounding box overlaps. As
+  long as the query radius is at most the cell size, a point only has to look
+  at the 2x2 block of cells around it.
+  """
+  def __init__(self, coords_m, coord_offsets, cell_size=50.0):
+    """
+    Args:
+      coords_m (np.ndarray) : float64[M, 2] projected coordinates of every edge geometry.
+      coord_offsets (np.ndarray) : int64[E+1] edge i owns coords_m[offsets[i]:offsets[i+1]].
+      cell_size (float) : grid cell size in meters.
+    """
+    self.cell_size = float(cell_size)
+
+    # Segments go from each coordinate to the next one on the same edge.
+    num_edges = len(coord_offsets) - 1
+    coord_edge = np.repeat(np.arange(num_edges), np.diff(coord_offsets))
+    starts = np.flatnonzero(coord_edge[:-1] == coord_edge[1:])
+    self.seg_a = coords_m[starts]
+    self.seg_b = coords_m[starts + 1]
+    self.seg_edge = coord_edge[starts]
+
+    # Distance along the edge to the start of each segment.
+    seg_length = np.hypot(*(self.seg_b - self.seg_a).T)
+    cum = np.cumsum(seg_length)
+    edge_first_seg = np.searchsorted(self.seg_edge, self.seg_edge)
+    self.seg_along = cum - seg_length - (cum - seg_length)[edge_first_seg]
+    self.edge_length_m = np.bincount(self.seg_edge, weights=seg_length, minlength=num_edges)
+
+    # Put every segment into all of the cells its bounding box touches.
+    self.origin = coords_m.min(axis=0) if len(coords_m) > 0 else np.zeros(2)
+    lo = self._cell(np.minimum(self.seg_a, self.seg_b))
+    hi = self._cell(np.maximum(self.seg_a, self.seg_b))
+    self.grid_height = int(hi[:, 1].max()) + 2 if len(hi) > 0 else 1
+
+    nx = hi[:, 0] - lo[:, 0] + 1
+    ny = hi[:, 1] - lo[:, 1] + 1
+    counts = nx * ny
+    seg = np.repeat(np.arange(len(counts)), counts)
+    k = np.arange(len(seg)) - np.repeat(np.cumsum(counts) - counts, counts)
+    cells = self._key(lo[seg, 0] + k // ny[seg], lo[seg, 1] + k % ny[seg])
+
+    order = np.argsort(cells, kind='stable')
+    self.cell_keys, cell_starts = np.unique(cells[order], return_index=True)
+    self.cell_starts = np.append(cell_starts, len(order)).astype(np.int64)
+    self.cell_segs = seg[order]
+
+  def _cell(self, xy):
+    return np.floor((xy - self.origin) / self.cell_size).astype(np.int64)
+
+  def _key(self, cx, cy):
+    return cx * self.grid_height + cy
+
+  @property
+  def nbytes(self):
+    return sum(a.nbytes for a in (self.seg_a, self.seg_b, self.seg_edge, self.seg_along, self.edge_length_m,
+                                  self.cell_keys, self.cell_starts, self.cell_segs))
+
+  def query(self, xy, radius):
+    """
+    Find every edge within radius of each point.
+
+    Args:
+      xy (np.ndarray) : (N, 2) array of projected points.
+      radius (float) : search radius in meters, at most the cell size.
+
+    Returns:
+      (tuple) of point index, edge index, distance to the edge and position of
+      the closest point along the edge (meters from its start), with one entry
+      per nearby (point, edge) pair. Sorted by point, then edge.
+    """
+    assert radius <= self.cell_size
+    xy = np.asarray(xy, dtype=np.float64).reshape(-1, 2)
+    lo = self._cell(xy - radius)
+    hi = self._cell(xy + radius)
+
+    # Look up the (at most) 2x2 cells around each point.
+    point, cell = [], []
+    for dx in (0, 1):
+      for dy in (0, 1):
+        ok = (lo[:, 0] + dx <= hi[:, 0]) & (lo[:, 1] + dy <= hi[:, 1])
+        ok &= (lo[:, 1] + dy >= 0) & (lo[:, 1] + dy < self.grid_height)
+        point.append(np.flatnonzero(ok))
+        cell.append(self._key(lo[ok, 0] + dx, lo[ok, 1] + dy))
+    point = np.concatenate(point)
+    cell = np.concatenate(cell)
+
+    pos = np.minimum(np.searchsorted(self.cell_keys, cell), len(self.cell_keys) - 1)
+    found = self.cell_keys[pos] == cell
+    point, pos = point[found], pos[found]
+    counts = self.cell_starts[pos + 1] - self.cell_starts[pos]
+    entry = np.repeat(self.cell_starts[pos] - np.cumsum(counts) + counts, counts) + np.arange(counts.sum())
+    point = np.repeat(point, counts)
+    seg = self.cell_segs[entry]
+
+    # Exact point-to-segment distances.
+    a, b, p = self.seg_a[seg], self.seg_b[seg], xy[point]
+    ab = b - a
+    denom = np.maximum((ab * ab).sum(axis=1), 1e-12)
+    t = np.clip(((p - a) * ab).sum(axis=1) / denom, 0.0, 1.0)
+    dist = np.hypot(*(a + t[:, None] * ab - p).T)
+    along = self.seg_along[seg] + t * np.sqrt(denom)
+
+    near = dist <= radius
+    point, edge, dist, along = point[near], self.seg_edge[seg[near]], dist[near], along[near]
+
+    # Keep the closest segment of each edge for each point.
+    order = np.lexsort((dist, edge, point))
+    point, edge, dist, along = point[order], edge[order], dist[order], along[order]
+    first = np.ones(len(point), dtype=bool)
+    first[1:] = (point[1:] != point[:-1]) | (edge[1:] != edge[:-1])
+
+    return point[first], edge[first], dist[first], along[first]
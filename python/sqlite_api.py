@@ -0,0 +1,499 @@
+import base64
+from contextlib import contextmanager
+import json
+import os
+import sqlite3
+import threading
+
+import numpy as np
+
+from python.coverage_bits import edge_bits, edge_id_bits, from_record, merge_bits
+from python.file_util import top_folder
+from python.graph_registry import get_graph
+import python.metrics as metrics
+from python.storage import ACTIVITY_META_FIELDS, activity_record, encode_coordinates
+from python.user_stats import METERS_TO_MI, add_activity_totals, set_map_coverage
+
+#===============================================================================
+
+# Activity routes are stored as encoded polylines (see storage.activity_record), and coverage as a
+# bitset over the map's edges (see python/coverage_bits.py).
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS activities (
+  user_id TEXT NOT NULL,
+  activity_id TEXT NOT NULL,
+  id,
+  name TEXT,
+  distance REAL NOT NULL,
+  start_date TEXT,
+  moving_time REAL NOT NULL,
+  polyline TEXT NOT NULL,
+  PRIMARY KEY (user_id, activity_id)
+) WITHOUT ROWID;
+
+CREATE INDEX IF NOT EXISTS activities_by_start_date ON activities (user_id, start_date, activity_id);
+
+CREATE TABLE IF NOT EXISTS coverage_bits (
+  user_id TEXT NOT NULL,
+  map_id TEXT NOT NULL,
+  version TEXT NOT NULL,
+  num_edges INTEGER NOT NULL,
+  bits BLOB NOT NULL,
+  PRIMARY KEY (user_id, map_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS processed (
+  user_id TEXT NOT NULL,
+  map_id TEXT NOT NULL,
+  activity_id TEXT NOT NULL,
+  PRIMARY KEY (user_id, map_id, activity_id)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS stats (
+  user_id TEXT PRIMARY KEY,
+  data TEXT NOT NULL
+);
+'''
+
+# Stay well under SQLite's limit on the number of parameters in a statement.
+MAX_PARAMS = 500
+
+_local = threading.local()
+
+
+def database_path():
+  """
+  Path of the database file, from the SQLITE_DB_PATH environment variable (default 'everystreet.sqlite3').
+  """
+  return os.getenv('SQLITE_DB_PATH', top_folder('everystreet.sqlite3'))
+
+
+def connection():
+  """
+  Get this thread's connection to the database, creating the tables the first time.
+  """
+  path = database_path()
+  conn = getattr(_local, 'conn', None)
+  if conn is None or _local.path != path:
+    # Autocommit, so that transactions are only the ones opened by transaction().
+    conn = sqlite3.connect(path, isolation_level=None, timeout=30.0)
+    conn.execute('PRAGMA journal_mode=WAL')
+    conn.execute('PRAGMA synchronous=NORMAL')
+    conn.executescript(SCHEMA)
+    _migrate(conn)
+    _local.conn, _local.path = conn, path
+  return conn
+
+
+def _migrate(conn):
+  """
+  Convert a database written before activity routes were stored encoded.
+  """
+  columns = [r[1] for r in conn.execute('PRAGMA table_info(activities)')]
+  if 'geometry' not in columns:
+    return
+
+  conn.execute('BEGIN IMMEDIATE')
+  try:
+    conn.execute('ALTER TABLE activities ADD COLUMN polyline TEXT')
+    rows = conn.execute('SELECT user_id, activity_id, geometry FROM activities').fetchall()
+    conn.executemany('UPDATE activities SET polyline = ? WHERE user_id = ? AND activity_id = ?',
+                     ((encode_coordinates(json.loads(g)['coordinates']), u, a) for u, a, g in rows))
+    conn.execute('ALTER TABLE activities DROP COLUMN geometry')
+  except BaseException:
+    conn.execute('ROLLBACK')
+    raise
+  conn.execute('COMMIT')
+
+
+@contextmanager
+def transaction():
+  """
+  Run everything inside a with block as one write transaction, which is
+  rolled back if the block raises.
+  """
+  conn = connection()
+  conn.execute('BEGIN IMMEDIATE')
+  try:
+    yield conn
+  except BaseException:
+    conn.execute('ROLLBACK')
+    raise
+  conn.execute('COMMIT')
+
+
+def _select_in(conn, query, params, values):
+  """
+  Run a query with an 'IN ({})' clause over many values, in chunks.
+  """
+  rows = []
+  for i in range(0, len(values), MAX_PARAMS):
+    chunk = values[i:i+MAX_PARAMS]
+    rows.extend(conn.execute(query.format(','.join('?' * len(chunk))), list(params) + chunk).fetchall())
+  return rows
+
+
+def _activity(row):
+  _, activity_id, name, distance, start_date, moving_time, polyline = row
+  return {'id': activity_id, 'name': name, 'distance': distance, 'start_date': start_date, 'moving_time': moving_time,
+          'polyline': polyline}
+
+
+_ACTIVITY_COLUMNS = 'activity_id, id, name, distance, start_date, moving_time, polyline'
+
+#===============================================================================
+
+@metrics.timed('sqlite.get_processed_activity_ids_for_map')
+def get_processed_activity_ids_for_map(user_id, map_id):
+  """
+  Get a set of all user's activity IDs that have been processed so far.
+  """
+  rows = connection().execute('SELECT activity_id FROM processed WHERE user_id = ? AND map_id = ?',
+                              (user_id, map_id))
+  return set(r[0] for r in rows)
+
+#===============================================================================
+
+@metrics.timed('sqlite.get_activity_data')
+def get_activity_data(user_id):
+  """
+  Get metadata about user activities that have been processed so far.
+  """
+  rows = connection().execute('SELECT {} FROM activities WHERE user_id = ?'.format(_ACTIVITY_COLUMNS), (user_id,))
+  d = {r[0]: _activity(r) for r in rows}
+  return d if d else None
+
+#===============================================================================
+
+@metrics.timed('sqlite.get_activity_ids')
+def get_activity_ids(user_id):
+  """
+  Get the set of IDs of the user's activities.
+  """
+  rows = connection().execute('SELECT activity_id FROM activities WHERE user_id = ?', (user_id,))
+  return set(r[0] for r in rows)
+
+#===============================================================================
+
+@metrics.timed('sqlite.get_activity_by_id')
+def get_activity_by_id(user_id, activity_id):
+  """
+  Get metadata about user activities that have been processed so far.
+  """
+  row = connection().execute(
+      'SELECT {} FROM activities WHERE user_id = ? AND activity_id = ?'.format(_ACTIVITY_COLUMNS),
+      (user_id, str(activity_id))).fetchone()
+  return _activity(row) if row is not None else None
+
+#===============================================================================
+
+@metrics.timed('sqlite.get_activity_page')
+def get_activity_page(user_id, before=None, limit=50):
+  """
+  Get the metadata (see storage.ACTIVITY_META_FIELDS) of a page of the user's
+  activities, newest first, straight from the start_date index.
+
+  Args:
+    user_id (str) : the user whose activities to list.
+    before (tuple) : optional (start_date, activity ID) to start after.
+    limit (int) : maximum number of activities to get.
+
+  Returns:
+    (list) of dicts, ordered by (start_date, activity ID) from newest to oldest.
+  """
+  query = 'SELECT id, name, distance, start_date, moving_time FROM activities WHERE user_id = ?'
+  params = [user_id]
+  if before is not None:
+    query += ' AND (start_date, activity_id) < (?, ?)'
+    params.extend(before)
+  query += ' ORDER BY start_date DESC, activity_id DESC LIMIT ?'
+  params.append(limit)
+
+  return [dict(zip(ACTIVITY_META_FIELDS, row)) for row in connection().execute(query, params)]
+
+#===============================================================================
+
+@metrics.timed('sqlite.get_user_stats')
+def get_user_stats(user_id):
+  """
+  Get user stats from the database.
+  """
+  row = connection().execute('SELECT data FROM stats WHERE user_id = ?', (user_id,)).fetchone()
+  return json.loads(row[0]) if row is not None else {}
+
+#===============================================================================
+
+def _coverage_record(row):
+  version, num_edges, bits = row
+  return {'version': version, 'num_edges': num_edges, 'bits': base64.b64encode(bits).decode('ascii')}
+
+
+@metrics.timed('sqlite.get_coverage')
+def get_coverage(user_id, map_id):
+  """
+  Get the user's coverage of a map, in the form stored by coverage_bits.to_record (or None if there isn't any).
+  """
+  row = connection().execute('SELECT version, num_edges, bits FROM coverage_bits WHERE user_id = ? AND map_id = ?',
+                             (user_id, map_id)).fetchone()
+  return _coverage_record(row) if row is not None else None
+
+#===============================================================================
+
+@metrics.timed('sqlite.add_or_update_activity')
+def add_or_update_activity(user_id, activity_id, activity_data):
+  """
+  Store metadata from Strava along with the route, as the encoded polyline
+  Strava sends (see storage.activity_record), and add it to the user's stats.
+  """
+  add_or_update_activities(user_id, [(activity_id, activity_data)])
+
+
+@metrics.timed('sqlite.add_or_update_activities')
+def add_or_update_activities(user_id, activities):
+  """
+  Store many activities (see add_or_update_activity) and add them to the
+  user's stats, all in one transaction.
+
+  Args:
+    user_id (str) : the user the activities belong to.
+    activities (list) : of (activity_id, activity_data from Strava) tuples.
+  """
+  records = {str(a): activity_record(a, d) for a, d in activities}
+  if not records:
+    return
+
+  with transaction() as conn:
+    # So that an activity that's pulled again only counts once.
+    previous = _select_in(conn, 'SELECT activity_id, distance, moving_time FROM activities '
+                                'WHERE user_id = ? AND activity_id IN ({})', [user_id], list(records))
+    distance = sum(r['distance'] for r in records.values()) - sum(r[1] for r in previous)
+    moving_time = sum(r['moving_time'] for r in records.values()) - sum(r[2] for r in previous)
+    count = len(records) - len(previous)
+
+    conn.executemany(
+      'INSERT OR REPLACE INTO activities (user_id, {}) VALUES (?, ?, ?, ?, ?, ?, ?, ?)'.format(_ACTIVITY_COLUMNS),
+      ((user_id, key, r['id'], r['name'], r['distance'], r['start_date'], r['moving_time'], r['polyline'])
+       for key, r in records.items()))
+
+    _update_stats(conn, user_id, lambda stats: add_activity_totals(stats, METERS_TO_MI * distance,
+                                                                   moving_time / 3600.0, count))
+
+
+def migrate_activity_geometry(user_id):
+  """
+  Databases written before activity routes were stored encoded are converted
+  when they're opened (see _migrate), so there's nothing left to do.
+
+  Returns:
+    (int) the number of activities that were converted.
+  """
+  connection()
+  return 0
+
+#===============================================================================
+
+def _merge_coverage(conn, user_id, map_id, graph, bits):
+  """
+  OR bits into the user's stored coverage of a map, and update the map's stats from the result.
+  Must be inside a transaction.
+  """
+  row = conn.execute('SELECT version, num_edges, bits FROM coverage_bits WHERE user_id = ? AND map_id = ?',
+                     (user_id, map_id)).fetchone()
+  merged = merge_bits(from_record(graph, _coverage_record(row) if row is not None else None), bits)
+  conn.execute('INSERT OR REPLACE INTO coverage_bits VALUES (?, ?, ?, ?, ?)',
+               (user_id, map_id, graph.edge_order_version, graph.num_edges, merged.tobytes()))
+  _update_stats(conn, user_id, lambda stats: set_map_coverage(stats, map_id, graph, merged))
+
+
+class CoverageWriter(object):
+  """
+  Collects the edges completed by many activities, and saves them once there
+  are max_activities of them (or on flush). Works the same way as
+  firebase_api.CoverageWriter, except that the coverage, the processed flags
+  and the map's stats are all written in one transaction.
+  """
+  def __init__(self, user_id, map_id, graph=None, max_activities=None):
+    """
+    Args:
+      user_id (str) : the user to write coverage for.
+      map_id (str) : the map the edges are from.
+      graph (MatchGraph) : optional graph for the map. Taken from the graph
+        registry if not given.
+      max_activities (int) : number of activities to collect before writing
+        them. Defaults to the COVERAGE_BATCH_ACTIVITIES environment variable, or 500.
+    """
+    self.user_id = user_id
+    self.map_id = map_id
+    self.graph = graph
+    self.max_activities = max_activities if max_activities is not None else \
+        int(os.getenv('COVERAGE_BATCH_ACTIVITIES', 500))
+
+    self._pending = []
+
+    self.written = []
+    self.failed = {}
+    self.num_updates = 0
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.flush()
+
+  def add(self, activity_id, edge_idx):
+    """
+    Args:
+      activity_id (str) : the activity that was matched.
+      edge_idx (np.ndarray) : indices of the edges it completed, in the map's graph.
+    """
+    self._pending.append((str(activity_id), np.asarray(edge_idx, dtype=np.int64)))
+    if len(self._pending) >= self.max_activities:
+      self.flush()
+
+  @metrics.timed('sqlite.coverage_flush')
+  def flush(self):
+    """
+    Write everything that's been added so far.
+    """
+    pending, self._pending = self._pending, []
+    if not pending:
+      return
+
+    if self.graph is None:
+      self.graph = get_graph(self.map_id)
+    bits = edge_bits(self.graph.num_edges, np.concatenate([idx for _, idx in pending]))
+
+    try:
+      self.num_updates += 1
+      with transaction() as conn:
+        _merge_coverage(conn, self.user_id, self.map_id, self.graph, bits)
+        conn.executemany('INSERT OR IGNORE INTO processed VALUES (?, ?, ?)',
+                         ((self.user_id, self.map_id, activity_id) for activity_id, _ in pending))
+      self.written.extend(activity_id for activity_id, _ in pending)
+    except Exception as e:
+      self.failed.update((activity_id, str(e)) for activity_id, _ in pending)
+
+
+@metrics.timed('sqlite.update_coverage')
+def update_coverage(user_id, map_id, activity_id, edge_idx, graph=None):
+  """
+  Save completed edges to the database for visualization and coverage metrics.
+  Use a CoverageWriter instead to save many activities at once.
+  """
+  writer = CoverageWriter(user_id, map_id, graph=graph)
+  writer.add(activity_id, edge_idx)
+  writer.flush()
+  if writer.failed:
+    raise RuntimeError(writer.failed[str(activity_id)])
+
+
+@metrics.timed('sqlite.migrate_coverage')
+def migrate_coverage(user_id, map_id, graph=None):
+  """
+  Convert coverage saved as a copy of every completed edge (in the old
+  'coverage' table) into bits, and delete the copies.
+
+  Returns:
+    (int) the number of edge ids that were converted.
+  """
+  conn = connection()
+  if conn.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'coverage'").fetchone() is None:
+    return 0
+  if graph is None:
+    graph = get_graph(map_id)
+
+  with transaction() as conn:
+    edge_ids = [r[0] for r in conn.execute('SELECT edge_id FROM coverage WHERE user_id = ? AND map_id = ?',
+                                           (user_id, map_id))]
+    if edge_ids:
+      _merge_coverage(conn, user_id, map_id, graph, edge_id_bits(graph, edge_ids))
+      conn.execute('DELETE FROM coverage WHERE user_id = ? AND map_id = ?', (user_id, map_id))
+      conn.execute('DELETE FROM completed_by WHERE user_id = ? AND map_id = ?', (user_id, map_id))
+  return len(edge_ids)
+
+#===============================================================================
+
+def _update_stats(conn, user_id, update):
+  # Must be inside a transaction.
+  row = conn.execute('SELECT data FROM stats WHERE user_id = ?', (user_id,)).fetchone()
+  stats = update(json.loads(row[0]) if row is not None else {})
+  conn.execute('INSERT OR REPLACE INTO stats VALUES (?, ?)', (user_id, json.dumps(stats)))
+  return stats
+
+
+@metrics.timed('sqlite.update_user_stats')
+def update_user_stats(user_id, update):
+  """
+  Apply a change to the user's stats in a transaction.
+
+  Args:
+    user_id (str) : the user to update.
+    update (callable) : takes the current stats dict (empty if there aren't
+      any yet) and returns the new one, e.g. using add_activity_totals.
+
+  Returns:
+    (dict) the new stats.
+  """
+  with transaction() as conn:
+    return _update_stats(conn, user_id, update)
+
+
+@metrics.timed('sqlite.recompute_user_stats')
+def recompute_user_stats(user_id, graphs=None):
+  """
+  Re-compute total user stats from scratch, and overwrite the ones that are
+  kept up to date as activities and coverage are added. Only meant for
+  repairing the stats.
+
+  Args:
+    user_id (str) : the user to update.
+    graphs (dict) : optional map_id to MatchGraph. Maps that aren't in it are
+      taken from the graph registry.
+  """
+  with transaction() as conn:
+    distance, time, count = conn.execute(
+        'SELECT COALESCE(SUM(distance), 0), COALESCE(SUM(moving_time), 0), COUNT(*) FROM activities '
+        'WHERE user_id = ?', (user_id,)).fetchone()
+    p = add_activity_totals({}, METERS_TO_MI * distance, time / 3600.0, count)
+
+    p['coverage'] = {}
+    for map_id, version, num_edges, bits in conn.execute(
+        'SELECT map_id, version, num_edges, bits FROM coverage_bits WHERE user_id = ?', (user_id,)).fetchall():
+      graph = (graphs or {}).get(map_id) or get_graph(map_id)
+      set_map_coverage(p, map_id, graph, from_record(graph, _coverage_record((version, num_edges, bits))))
+
+    conn.execute('INSERT OR REPLACE INTO stats VALUES (?, ?)', (user_id, json.dumps(p)))
+
+  return p
+
+#===============================================================================
+
+def cache_stats():
+  """
+  Reads are local, so there's no read cache.
+  """
+  return {}
+
+#===============================================================================
+#============================ DATABASE MAINTENANCE =============================
+#===============================================================================
+
+
+def clear_user_activities(user_id):
+  def reset(stats):
+    stats.update(add_activity_totals({}, 0.0, 0.0, 0))
+    return stats
+
+  with transaction() as conn:
+    conn.execute('DELETE FROM activities WHERE user_id = ?', (user_id,))
+    _update_stats(conn, user_id, reset)
+
+
+def clear_user_coverage(user_id, map_id):
+  def reset(stats):
+    stats.get('coverage', {}).pop(map_id, None)
+    return stats
+
+  with transaction() as conn:
+    conn.execute('DELETE FROM coverage_bits WHERE user_id = ? AND map_id = ?', (user_id, map_id))
+    _update_stats(conn, user_id, reset)
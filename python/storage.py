@@ -0,0 +1,193 @@
+import importlib
+import os
+
+import numpy as np
+import polyline
+
+
+# Modules that implement the storage interface, by STORAGE_BACKEND name.
+BACKENDS = {
+  'firebase': 'python.firebase_api',
+  'sqlite': 'python.sqlite_api',
+}
+
+# What every backend module provides. Each one stores the same data, and
+# returns it in the same form as the Firebase tree under 'user_data/<user_id>'.
+INTERFACE = (
+  'get_processed_activity_ids_for_map',
+  'get_activity_data',
+  'get_activity_ids',
+  'get_activity_by_id',
+  'get_activity_page',
+  'get_user_stats',
+  'get_coverage',
+  'add_or_update_activity',
+  'add_or_update_activities',
+  'CoverageWriter',
+  'update_coverage',
+  'update_user_stats',
+  'recompute_user_stats',
+  'clear_user_activities',
+  'clear_user_coverage',
+  'migrate_activity_geometry',
+  'migrate_coverage',
+  'cache_stats',
+)
+
+
+def backend_name():
+  """
+  Name of the storage backend to use, from the STORAGE_BACKEND environment variable (default 'firebase').
+  """
+  return os.getenv('STORAGE_BACKEND', 'firebase')
+
+
+def load_backend(name=None):
+  """
+  Import a storage backend. Backends are only imported when they're picked, so
+  the SQLite one works without any Firebase credentials.
+
+  Args:
+    name (str) : one of BACKENDS. Defaults to backend_name().
+
+  Returns:
+    (module) with every function in INTERFACE.
+
+  Raises:
+    ValueError if there's no backend called name.
+    ImportError if the backend's module doesn't have everything in INTERFACE.
+  """
+  name = name or backend_name()
+  if name not in BACKENDS:
+    raise ValueError('Unknown storage backend {} (expected one of {})'.format(name, sorted(BACKENDS)))
+
+  backend = importlib.import_module(BACKENDS[name])
+  missing = [attr for attr in INTERFACE if not hasattr(backend, attr)]
+  if missing:
+    raise ImportError('Storage backend {} ({}) is missing {}'.format(name, BACKENDS[name], ', '.join(missing)),
+                      name=BACKENDS[name])
+  return backend
+
+
+def activity_record(activity_id, activity_data):
+  """
+  Get the part of an activity from Strava that we store.
+
+  The route is kept as Strava's encoded polyline, which is several times
+  smaller than the decoded coordinates (and exactly as precise, since that's
+  what they were decoded from). Use activity_coordinates() or
+  activity_geometry() where the points are actually needed.
+  """
+  return {
+    'id': activity_id,
+    'name': activity_data['name'],
+    'distance': activity_data['distance'],
+    'start_date': activity_data['start_date'],
+    'moving_time': activity_data['moving_time'],
+    'polyline': activity_data['map']['polyline']
+  }
+
+
+# The fields of an activity that are listed a page at a time (see get_activity_page).
+ACTIVITY_META_FIELDS = ('id', 'name', 'distance', 'start_date', 'moving_time')
+
+
+def activity_meta(activity):
+  """
+  Get just the metadata of a stored activity (everything but its route).
+  """
+  return {field: activity[field] for field in ACTIVITY_META_FIELDS}
+
+
+def activity_cursor(activity):
+  """
+  Get the cursor for the page of activities that comes after this one (see ActivityPage).
+  """
+  return '{}_{}'.format(activity['start_date'], activity['id'])
+
+
+def parse_activity_cursor(cursor):
+  """
+  Returns:
+    (tuple) of the start_date and activity ID in a cursor from activity_cursor, or None for no cursor.
+  """
+  if not cursor:
+    return None
+  start_date, sep, activity_id = cursor.rpartition('_')
+  if not sep or not start_date or not activity_id:
+    raise ValueError('Invalid activity cursor {}'.format(cursor))
+  return start_date, activity_id
+
+
+class ActivityPage(object):
+  """
+  One page of a user's activities, newest first, for a template.
+
+  The page is read by fetch (or the first time it's iterated over). Call
+  fetch before streaming a template, so that a failed read can still be
+  reported as an error instead of a cut-off page. After that, next_cursor
+  is the cursor for the next (older) page, or None if this is the last one.
+  """
+  def __init__(self, backend, user_id, cursor=None, limit=50):
+    """
+    Args:
+      backend (module) : the storage backend (see load_backend).
+      user_id (str) : the user whose activities to list.
+      cursor (str) : from activity_cursor, to start after. None for the newest activities.
+      limit (int) : maximum number of activities on the page.
+    """
+    self.backend = backend
+    self.user_id = user_id
+    self.before = parse_activity_cursor(cursor)
+    self.limit = limit
+    self.next_cursor = None
+    self.activities = None
+
+  def fetch(self):
+    """
+    Read the page, if it hasn't been read yet.
+
+    Returns:
+      (list) of the page's activities (see get_activity_page in the backends).
+    """
+    if self.activities is None:
+      # Ask for one extra activity, to know whether there's another page.
+      activities = self.backend.get_activity_page(self.user_id, before=self.before, limit=self.limit + 1)
+      if len(activities) > self.limit:
+        activities = activities[:self.limit]
+        self.next_cursor = activity_cursor(activities[-1])
+      self.activities = activities
+    return self.activities
+
+  def __iter__(self):
+    return iter(self.fetch())
+
+
+def activity_coordinates(activity):
+  """
+  Decode a stored activity's route.
+
+  Activities saved before routes were stored encoded have a geojson
+  'geometry' instead of a 'polyline' (see migrate_activity_geometry in the
+  backends), and those are read as is.
+
+  Returns:
+    (np.ndarray) of shape (N, 2) with the [lng, lat] points.
+  """
+  if 'polyline' in activity:
+    return np.array(polyline.decode(activity['polyline']), dtype=np.float64).reshape(-1, 2)[:, ::-1]
+  return np.array(activity['geometry']['coordinates'], dtype=np.float64).reshape(-1, 2)
+
+
+def activity_geometry(activity):
+  """
+  Get a stored activity's route as a geojson LineString.
+  """
+  return {'type': 'LineString', 'coordinates': activity_coordinates(activity).tolist()}
+
+
+def encode_coordinates(coordinates):
+  """
+  Encode [lng, lat] points as a polyline (the inverse of activity_coordinates).
+  """
+  return polyline.encode([(lat, lng) for lng, lat in coordinates])
@@ -1,20 +1,94 @@
 import os
+import random
+import threading
+
 import requests
+from requests.adapters import HTTPAdapter
 import urllib3
+from urllib3.util.retry import Retry
 from dotenv import load_dotenv
 
+import python.metrics as metrics
+
 load_dotenv() # Take environment variables from .env.
 
 # Not sure if this is needed; copied from tutorial.
 urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
 
+# Can be pointed at a stand-in server for testing.
+STRAVA_URL = os.getenv('STRAVA_URL', 'https://www.strava.com')
+
+#===============================================================================
+
+class JitteredRetry(Retry):
+  """
+  Retry with "full jitter" backoff: each wait is random, up to the usual
+  exponential backoff time, so that clients that failed together don't all
+  retry at the same moment.
+  """
+  def get_backoff_time(self):
+    return random.uniform(0, super().get_backoff_time())
+
+
+def make_session(pool_size=None, retries=None, backoff=None):
+  """
+  Make a requests session that keeps connections to Strava alive and reuses them.
+
+  Requests that fail to connect, time out, or get a 5xx response are retried.
+  Once the retries run out, a 5xx response is returned as usual.
+
+  Args:
+    pool_size (int) : maximum number of connections to keep open at once, for
+      requests on several threads. Defaults to the STRAVA_POOL_SIZE environment variable, or 10.
+    retries (int) : number of times to retry a request. Defaults to STRAVA_RETRIES, or 3.
+    backoff (float) : the longest wait before the first retry, in seconds.
+      It doubles with each retry after that. Defaults to STRAVA_BACKOFF, or 0.5.
+  """
+  pool_size = pool_size if pool_size is not None else int(os.getenv('STRAVA_POOL_SIZE', 10))
+  retries = retries if retries is not None else int(os.getenv('STRAVA_RETRIES', 3))
+  backoff = backoff if backoff is not None else float(os.getenv('STRAVA_BACKOFF', 0.5))
+
+  # Refreshing the token is safe to repeat, so the POST to get one is retried too.
+  retry = JitteredRetry(total=retries, backoff_factor=backoff, status_forcelist=(500, 502, 503, 504),
+                        allowed_methods=frozenset(['GET', 'POST']), raise_on_status=False)
+  adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+
+  session = requests.Session()
+  session.mount('https://', adapter)
+  session.mount('http://', adapter)
+  return session
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def session():
+  """
+  Get the session shared by every request to Strava in this process (see make_session).
+  """
+  global _session
+  with _session_lock:
+    if _session is None:
+      _session = make_session()
+    return _session
+
+
+def timeout():
+  """
+  The (connect, read) timeout for each request, in seconds, from the
+  STRAVA_CONNECT_TIMEOUT and STRAVA_READ_TIMEOUT environment variables.
+  """
+  return float(os.getenv('STRAVA_CONNECT_TIMEOUT', 3.05)), float(os.getenv('STRAVA_READ_TIMEOUT', 30))
+
 #===============================================================================
 
+@metrics.timed('strava.get_token_always_valid')
 def get_token_always_valid():
   """
   Get a Strava API token that is always up-to-date.
   """
-  auth_url = "https://www.strava.com/oauth/token"
+  auth_url = STRAVA_URL + "/oauth/token"
 
   payload = {
     'client_id': os.getenv('STRAVA_CLIENT_ID'),
@@ -24,43 +98,46 @@ def get_token_always_valid():
     'f': 'json'
   }
 
-  res = requests.post(auth_url, data=payload, verify=False)
+  res = session().post(auth_url, data=payload, verify=False, timeout=timeout())
   access_token = res.json()['access_token']
 
   return access_token
 
 #===============================================================================
 
+@metrics.timed('strava.get_activity_by_id')
 def get_activity_by_id(access_token, id):
   """
   Requests info about an activity based on its unique ID.
 
   https://developers.strava.com/docs/reference/#api-Activities-getActivityById
   """
-  activites_url = "https://www.strava.com/api/v3/activities/{}".format(id)
+  activites_url = STRAVA_URL + "/api/v3/activities/{}".format(id)
   header = {'Authorization': 'Bearer ' + access_token}
   param = {'per_page': 200, 'page': 1}
-  response = requests.get(activites_url, headers=header, params=param).json()
+  response = session().get(activites_url, headers=header, params=param, timeout=timeout()).json()
 
   return response
 
 #===============================================================================
 
+@metrics.timed('strava.get_athlete_activities')
 def get_athlete_activities(access_token, before_time=None, after_time=None, page=1, per_page=30):
   """
   Returns a paginated list of the authenticated athlete's activities.
 
   https://developers.strava.com/docs/reference/#api-Activities-getLoggedInAthleteActivities
   """
-  activites_url = "https://www.strava.com/api/v3/athlete/activities/"
+  activites_url = STRAVA_URL + "/api/v3/athlete/activities/"
   header = {'Authorization': 'Bearer ' + access_token}
   param = {'before': before_time, 'after': after_time, 'per_page': per_page, 'page': page}
-  response = requests.get(activites_url, headers=header, params=param).json()
+  response = session().get(activites_url, headers=header, params=param, timeout=timeout()).json()
 
   return response
 
 #===============================================================================
 
+@metrics.timed('strava.get_activities_id_set')
 def get_activities_id_set(access_token, before_time=None, after_time=None, verbose=True):
   """
   Returns the IDs of all activities within the query times.
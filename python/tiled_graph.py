@@ -0,0 +1,282 @@
+from collections import OrderedDict
+import os
+import threading
+
+import numpy as np
+
+import python.match_graph as match_graph
+from python.match_graph import MatchGraph, local_transformer, project_points, ragged_take
+
+
+# Bump this whenever the tile layout changes.
+TILE_FORMAT_VERSION = 3
+
+
+def tile_folder_for(graph_file):
+  """
+  The tiles for 'static/graph_data/X.gpkg' live in 'static/graph_data/X.tiles/'.
+  """
+  return os.path.splitext(graph_file)[0] + '.tiles'
+
+
+def tile_name(tx, ty):
+  return '{}_{}'.format(tx, ty)
+
+
+def tile_of(xy_m, tile_size):
+  """
+  Get the integer (tx, ty) tile of projected points.
+  """
+  return np.floor(np.asarray(xy_m) / tile_size).astype(np.int64)
+
+
+def tile_contents(graph, tile_size):
+  """
+  Work out which nodes and edges go in each tile.
+
+  An edge goes in every tile that its bounding box (including its end nodes)
+  overlaps, so edges that cross a border are stored in each tile they touch.
+  A tile holds the nodes that are inside it, plus the far end of each of its
+  edges, so that its adjacency is complete for every node inside it.
+
+  Returns:
+    (dict) of tile name to sorted (node indices, edge indices) in graph.
+  """
+  starts = graph.edge_coord_offsets[:-1]
+  lo = np.minimum.reduceat(graph.edge_coords_m, starts, axis=0)
+  hi = np.maximum.reduceat(graph.edge_coords_m, starts, axis=0)
+  for end in (graph.edge_u, graph.edge_v):
+    lo = np.minimum(lo, graph.node_xy_m[end])
+    hi = np.maximum(hi, graph.node_xy_m[end])
+  lo, hi = tile_of(lo, tile_size), tile_of(hi, tile_size)
+
+  nx = hi[:, 0] - lo[:, 0] + 1
+  ny = hi[:, 1] - lo[:, 1] + 1
+  counts = nx * ny
+  edge = np.repeat(np.arange(len(counts)), counts)
+  k = np.arange(len(edge)) - np.repeat(np.cumsum(counts) - counts, counts)
+  edge_tile = np.column_stack((lo[edge, 0] + k // ny[edge], lo[edge, 1] + k % ny[edge]))
+
+  node_tile = tile_of(graph.node_xy_m, tile_size)
+
+  tiles, inverse = np.unique(np.concatenate([edge_tile, node_tile]), axis=0, return_inverse=True)
+  inverse = inverse.ravel()
+  edge_tile_id, node_tile_id = inverse[:len(edge)], inverse[len(edge):]
+
+  contents = {}
+  for i, (tx, ty) in enumerate(tiles):
+    edges = np.unique(edge[edge_tile_id == i])
+    nodes = np.union1d(np.flatnonzero(node_tile_id == i), np.concatenate([graph.edge_u[edges], graph.edge_v[edges]]))
+    contents[tile_name(tx, ty)] = (nodes.astype(np.int64), edges.astype(np.int64))
+  return contents
+
+
+def subgraph(graph, nodes, edges):
+  """
+  Cut the given (sorted) nodes and edges out of graph, as a MatchGraph in the
+  same projection. The end nodes of every edge must be included.
+  """
+  coords, coord_offsets = ragged_take(graph.edge_coords, graph.edge_coord_offsets, edges)
+  coords_m, _ = ragged_take(graph.edge_coords_m, graph.edge_coord_offsets, edges)
+  id_text, id_offsets = ragged_take(graph.edge_id_text, graph.edge_id_offsets, edges)
+  geojson_text, geojson_offsets = ragged_take(graph.edge_geojson_text, graph.edge_geojson_offsets, edges)
+  return MatchGraph(
+    graph.node_osmid[nodes],
+    graph.node_xy[nodes],
+    np.searchsorted(nodes, graph.edge_u[edges]).astype(np.int32),
+    np.searchsorted(nodes, graph.edge_v[edges]).astype(np.int32),
+    graph.edge_key[edges],
+    graph.edge_from[edges],
+    graph.edge_to[edges],
+    graph.edge_length[edges],
+    coords,
+    coord_offsets,
+    origin=graph.origin,
+    node_xy_m=graph.node_xy_m[nodes],
+    edge_coords_m=coords_m,
+    edge_id_text=id_text,
+    edge_id_offsets=id_offsets,
+    edge_geojson_text=geojson_text,
+    edge_geojson_offsets=geojson_offsets)
+
+
+def write_tiles(graph, graph_file, folder, tile_size):
+  """
+  Split graph into square tiles of tile_size meters (in the graph's own local
+  projection) and save them in folder, as the tiles for graph_file.
+
+  Each tile is a single '<tx>_<ty>.npz' with the MatchGraph.ARRAYS of the tile's
+  subgraph, plus 'node_global' and 'edge_global' with the index of each of its
+  nodes and edges in the whole graph. Tiles are small, so they're read eagerly
+  from one file instead of memory mapping a file per array.
+  """
+  contents = tile_contents(graph, tile_size)
+
+  def save(tmp_folder):
+    os.makedirs(tmp_folder, exist_ok=True)
+    for name, (nodes, edges) in contents.items():
+      tile = subgraph(graph, nodes, edges)
+      arrays = {a: np.ascontiguousarray(getattr(tile, a)) for a in MatchGraph.ARRAYS}
+      np.savez(os.path.join(tmp_folder, name + '.npz'), node_global=nodes, edge_global=edges, **arrays)
+
+  match_graph.write_cache(graph, graph_file, folder, save=save, version=TILE_FORMAT_VERSION,
+                          tile_size=float(tile_size), origin=[float(c) for c in graph.origin],
+                          num_nodes=graph.num_nodes, num_edges=graph.num_edges, tiles=sorted(contents))
+
+
+class TiledGraph(object):
+  """
+  A graph stored as spatial tiles (see write_tiles), that only loads the tiles
+  it's asked for.
+
+  Tiles are read when they're first needed and kept in an LRU of up to
+  max_tiles. Every tile uses the projection of the whole graph, so points
+  only need to be projected once, and the MatchGraph for a set of tiles gives
+  the same matches as the whole graph for anything inside them.
+  """
+  def __init__(self, folder, max_tiles=64, max_subgraphs=8):
+    """
+    Args:
+      folder (str) : folder written by write_tiles.
+      max_tiles (int) : maximum number of tiles to keep loaded.
+      max_subgraphs (int) : maximum number of merged tile sets to keep.
+    """
+    meta = match_graph.read_cache_meta(folder)
+    self.folder = folder
+    self.tile_size = meta['tile_size']
+    self.origin = np.array(meta['origin'], dtype=np.float64)
+    self.num_edges = meta['num_edges']
+    self.tile_names = frozenset(meta['tiles'])
+    self.transformer = local_transformer(float(self.origin[0]), float(self.origin[1]))
+
+    self.max_tiles = max_tiles
+    self.max_subgraphs = max_subgraphs
+    self._tiles = OrderedDict()
+    self._subgraphs = OrderedDict()
+    self._lock = threading.Lock()
+
+    self.tile_loads = 0
+
+  def project(self, points):
+    """
+    Project [lng, lat] points into the graph's local metric coordinates.
+    """
+    return project_points(self.transformer, points)
+
+  def tiles_for(self, xy_m, margin):
+    """
+    Names of the tiles that overlap the bounding box of some projected points,
+    grown by margin meters on every side.
+    """
+    xy_m = np.asarray(xy_m, dtype=np.float64).reshape(-1, 2)
+    if len(xy_m) == 0:
+      return []
+    lo = tile_of(xy_m.min(axis=0) - margin, self.tile_size)
+    hi = tile_of(xy_m.max(axis=0) + margin, self.tile_size)
+    names = (tile_name(tx, ty) for tx in range(lo[0], hi[0] + 1) for ty in range(lo[1], hi[1] + 1))
+    return [name for name in names if name in self.tile_names]
+
+  def _tile(self, name):
+    tile = self._tiles.get(name)
+    if tile is not None:
+      self._tiles.move_to_end(name)
+      return tile
+
+    with np.load(os.path.join(self.folder, name + '.npz')) as f:
+      tile = (MatchGraph(**{a: f[a] for a in MatchGraph.ARRAYS}), f['node_global'], f['edge_global'])
+    self.tile_loads += 1
+    self._tiles[name] = tile
+    while len(self._tiles) > self.max_tiles:
+      self._tiles.popitem(last=False)
+    return tile
+
+  def subgraph(self, names):
+    """
+    Get a MatchGraph covering the given tiles, loading them if needed.
+
+    Returns:
+      (tuple) of the MatchGraph, and the index in the whole graph of each of its edges.
+    """
+    key = tuple(sorted(names))
+    with self._lock:
+      cached = self._subgraphs.get(key)
+      if cached is not None:
+        self._subgraphs.move_to_end(key)
+        return cached
+
+      tiles = [self._tile(name) for name in key]
+      if len(tiles) == 1:
+        graph, _, edge_global = tiles[0]
+        cached = (graph, edge_global)
+      else:
+        cached = merge_tiles(tiles)
+
+      self._subgraphs[key] = cached
+      while len(self._subgraphs) > self.max_subgraphs:
+        self._subgraphs.popitem(last=False)
+      return cached
+
+  @property
+  def nbytes(self):
+    """
+    Total size of the loaded tiles in bytes.
+    """
+    return sum(graph.nbytes for graph, _, _ in self._tiles.values())
+
+  def stats(self):
+    return {'tiles': len(self.tile_names), 'loaded_tiles': len(self._tiles), 'tile_loads': self.tile_loads,
+            'nbytes': self.nbytes}
+
+
+def merge_tiles(tiles):
+  """
+  Merge (graph, node_global, edge_global) tiles into one MatchGraph, keeping a
+  single copy of the nodes and edges that are in more than one tile.
+
+  Returns:
+    (tuple) of the MatchGraph, and the index in the whole graph of each of its edges.
+  """
+  def cat(name):
+    return np.concatenate([getattr(graph, name) for graph, _, _ in tiles])
+
+  nodes, node_first = np.unique(np.concatenate([n for _, n, _ in tiles]), return_index=True)
+  edges, edge_first = np.unique(np.concatenate([e for _, _, e in tiles]), return_index=True)
+
+  # Edge end nodes, as indices in the whole graph.
+  u = np.concatenate([n[graph.edge_u] for graph, n, _ in tiles])[edge_first]
+  v = np.concatenate([n[graph.edge_v] for graph, n, _ in tiles])[edge_first]
+
+  def cat_offsets(name):
+    offsets = [np.zeros(1, dtype=np.int64)]
+    base = 0
+    for graph, _, _ in tiles:
+      offsets.append(getattr(graph, name)[1:] + base)
+      base += getattr(graph, name)[-1]
+    return np.concatenate(offsets)
+
+  coord_offsets = cat_offsets('edge_coord_offsets')
+  coords, new_offsets = ragged_take(cat('edge_coords'), coord_offsets, edge_first)
+  coords_m, _ = ragged_take(cat('edge_coords_m'), coord_offsets, edge_first)
+  id_text, id_offsets = ragged_take(cat('edge_id_text'), cat_offsets('edge_id_offsets'), edge_first)
+  geojson_text, geojson_offsets = ragged_take(cat('edge_geojson_text'), cat_offsets('edge_geojson_offsets'),
+                                              edge_first)
+
+  graph = MatchGraph(
+    cat('node_osmid')[node_first],
+    cat('node_xy')[node_first],
+    np.searchsorted(nodes, u).astype(np.int32),
+    np.searchsorted(nodes, v).astype(np.int32),
+    cat('edge_key')[edge_first],
+    cat('edge_from')[edge_first],
+    cat('edge_to')[edge_first],
+    cat('edge_length')[edge_first],
+    coords,
+    new_offsets,
+    origin=tiles[0][0].origin,
+    node_xy_m=cat('node_xy_m')[node_first],
+    edge_coords_m=coords_m,
+    edge_id_text=id_text,
+    edge_id_offsets=id_offsets,
+    edge_geojson_text=geojson_text,
+    edge_geojson_offsets=geojson_offsets)
+  return graph, edges
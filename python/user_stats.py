@@ -0,0 +1,55 @@
+from python.coverage_bits import coverage_totals
+
+
+# Stats are kept in miles and hours.
+METERS_TO_MI = 0.621371 / 1000
+
+
+def add_activity_totals(stats, distance, time, count):
+  """
+  Add to the activity totals in a user's stats.
+
+  Args:
+    stats (dict) : the user's stats, updated in place.
+    distance (float) : change in the total distance, in miles.
+    time (float) : change in the total moving time, in hours.
+    count (int) : change in the number of activities.
+  """
+  stats['total_distance'] = stats.get('total_distance', 0.0) + distance
+  stats['total_time'] = stats.get('total_time', 0.0) + time
+  stats['total_activities'] = stats.get('total_activities', 0) + count
+  return stats
+
+
+def map_coverage(graph, completed_edges, completed_distance):
+  """
+  Get the coverage stats for a map.
+
+  Args:
+    graph (MatchGraph) : the map's graph.
+    completed_edges (int) : number of completed edges.
+    completed_distance (float) : total length of the completed edges, in miles.
+  """
+  total_map_dist = graph.total_length * METERS_TO_MI
+  return {
+    'total_distance': total_map_dist,
+    'completed_distance': completed_distance,
+    'total_edges': graph.num_edges,
+    'completed_edges': completed_edges,
+    'percent_coverage': 100.0 * completed_distance / total_map_dist if total_map_dist > 0 else 0.0
+  }
+
+
+def set_map_coverage(stats, map_id, graph, bits):
+  """
+  Set the coverage stats for a map from the user's coverage of it.
+
+  Args:
+    stats (dict) : the user's stats, updated in place.
+    map_id (str) : the map the coverage is for.
+    graph (MatchGraph) : the map's graph.
+    bits (np.ndarray) : the completed edges (see python/coverage_bits.py).
+  """
+  completed_edges, completed_length = coverage_totals(graph, bits)
+  stats.setdefault('coverage', {})[map_id] = map_coverage(graph, completed_edges, completed_length * METERS_TO_MI)
+  return stats
@@ -0,0 +1,100 @@
+import base64
+import copy
+import os
+
+import firebase_admin
+import firebase_admin.credentials
+import firebase_admin.db
+import pytest
+
+
+class FakeReference(object):
+  """
+  Just enough of firebase_admin.db.Reference, backed by a dict.
+  """
+  def __init__(self, store, path):
+    self.store = store
+    self.path = [p for p in path.split('/') if p]
+
+  def child(self, path):
+    return FakeReference(self.store, '/'.join(self.path + [str(path)]))
+
+  def get(self, shallow=False):
+    node = self.store
+    for p in self.path:
+      if not isinstance(node, dict) or p not in node:
+        return None
+      node = node[p]
+    if shallow and isinstance(node, dict):
+      return {k: True for k in node}
+    return copy.deepcopy(node)
+
+  def set(self, value):
+    if value is None:
+      return self.delete()
+    node = self.store
+    for p in self.path[:-1]:
+      node = node.setdefault(p, {})
+    node[self.path[-1]] = copy.deepcopy(value)
+
+  def update(self, paths):
+    for path, value in paths.items():
+      self.child(path).set(value)
+
+  def delete(self):
+    node = self.store
+    for p in self.path[:-1]:
+      node = node.get(p, {})
+    node.pop(self.path[-1], None)
+
+  def transaction(self, update):
+    value = update(self.get())
+    self.set(value)
+    return value
+
+
+@pytest.fixture
+def api(monkeypatch):
+  os.environ.setdefault('FIREBASE_KEY_BASE64', base64.b64encode(b'{}').decode())
+  monkeypatch.setattr(firebase_admin.credentials, 'Certificate', lambda *args, **kwargs: None)
+  monkeypatch.setattr(firebase_admin, 'initialize_app', lambda *args, **kwargs: None)
+  store = {}
+  monkeypatch.setattr(firebase_admin.db, 'reference', lambda path: FakeReference(store, path))
+
+  import python.firebase_api as api
+  api.CACHE.clear()
+  api.store = store
+  return api
+
+
+def assert_same_totals(stats, expected):
+  for key in ('total_activities', 'total_distance', 'total_time'):
+    assert stats[key] == pytest.approx(expected[key])
+
+
+def strava_activity(distance, moving_time):
+  return {'map': {'polyline': '_p~iF~ps|U_ulLnnqC'}, 'name': 'Run', 'distance': distance,
+          'start_date': '2022-01-01T00:00:00Z', 'moving_time': moving_time}
+
+
+def test_pulling_an_activity_again_counts_it_once(api):
+  api.add_or_update_activity('u', 1, strava_activity(1000.0, 300))
+  api.add_or_update_activity('u', 1, strava_activity(1200.0, 360))
+
+  stats = api.get_user_stats('u')
+  assert stats['total_activities'] == 1
+  assert_same_totals(stats, api.recompute_user_stats('u', graphs={}))
+
+
+def test_pulling_an_activity_saved_before_activity_meta_again_counts_it_once(api):
+  api.add_or_update_activity('u', 1, strava_activity(1000.0, 300))
+  api.add_or_update_activity('u', 2, strava_activity(5000.0, 1500))
+  # The old format only had activity_data.
+  del api.store['user_data']['u']['activity_meta']
+  api.CACHE.clear()
+
+  api.add_or_update_activity('u', 2, strava_activity(5000.0, 1500))
+
+  stats = api.get_user_stats('u')
+  assert stats['total_activities'] == 2
+  assert_same_totals(stats, api.recompute_user_stats('u', graphs={}))
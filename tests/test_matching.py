@@ -0,0 +1,124 @@
+import numpy as np
+import pandas as pd
+import polyline
+import pytest
+
+from python.file_util import graph_data_folder, static_folder
+import python.matching as matching
+
+
+@pytest.fixture(scope='module')
+def graph():
+  return matching.load_match_graph(graph_data_folder('CAMBRIDGE_MA_US.gpkg'))
+
+
+@pytest.fixture(scope='module')
+def activities():
+  """
+  The activities in static/data.csv, as [lng, lat] arrays.
+  """
+  df = pd.read_csv(static_folder('data.csv'))
+  return [np.array(polyline.decode(p), dtype=np.float64)[:, ::-1] for p in df['polyline']]
+
+
+# Its last resampled point is near the end of one edge's list of nearby points, right before the first
+# point on the next edge.
+EDGE_END_ACTIVITY = [
+  [-71.10824453333333, 42.3683378],
+  [-71.10815444166667, 42.3681887625],
+  [-71.10806435, 42.368039724999996],
+  [-71.10806435, 42.368039724999996],
+]
+
+
+def test_segments_pair_at_end_of_edge_and_array(graph):
+  matched = matching.match_activities_by_segments([EDGE_END_ACTIVITY], graph)
+  assert len(matched) == 1
+  assert len(matched[0]) == 0
+
+
+def test_segments_pairs_stay_inside_each_activity(graph, activities):
+  batch = [EDGE_END_ACTIVITY] + activities + [EDGE_END_ACTIVITY]
+  matched = matching.match_activities_by_segments(batch, graph)
+  for a, edges in zip(batch, matched):
+    np.testing.assert_array_equal(edges, matching.match_activities_by_segments([a], graph)[0])
+  assert sum(len(edges) for edges in matched) > 0
+
+
+def old_loop_edges(nodes, dists, find_edges, max_node_dist, max_tries=10):
+  """
+  The matcher's original per-point loop, on one sequence of nearest-node candidates.
+  """
+  n = len(dists)
+  edges = []
+  for i in range(n - 1):
+    valid_i = dists[i] < max_node_dist
+    if not valid_i[0]:
+      continue
+
+    j = i + 1
+    done = False
+    tries = max_tries
+    while j < n - 1 and not done and tries > 0:
+      while j < n - 1 and dists[j, 0] > max_node_dist:
+        j += 1
+      if dists[j, 0] > max_node_dist:
+        continue
+
+      # The end's candidates are picked with the start's distances, like the original did.
+      for u in nodes[i][valid_i]:
+        for v in nodes[j][valid_i]:
+          e = find_edges(np.array([u]), np.array([v]))[0]
+          if e < 0:
+            e = find_edges(np.array([v]), np.array([u]))[0]
+          if e >= 0:
+            edges.append(e)
+            done = True
+      j += 1
+      tries -= 1
+  return np.array(edges, dtype=np.int64)
+
+
+def test_node_candidates_match_old_loop_across_sequences():
+  rng = np.random.default_rng(0)
+  num_nodes = 12
+  edge_index = {(u, v): k for k, (u, v) in enumerate(rng.integers(num_nodes, size=(30, 2)).tolist())}
+  find_edges = matching.edge_finder_from_index(edge_index)
+
+  # Sequences of every length from 0 to 3, plus long ones, in between each other.
+  lengths = [0, 40, 1, 2, 0, 3, 25, 1, 60, 0]
+  offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+  np.cumsum(lengths, out=offsets[1:])
+  nodes = rng.integers(num_nodes, size=(offsets[-1], 3))
+  dists = np.sort(rng.uniform(0, 60, size=(offsets[-1], 3)), axis=1)
+
+  edges, edge_offsets = matching.match_node_candidates(nodes, dists, find_edges, max_node_dist=30,
+                                                       offsets=offsets, block_size=7)
+  assert len(edge_offsets) == len(offsets)
+  for s in range(len(lengths)):
+    seq = slice(offsets[s], offsets[s + 1])
+    np.testing.assert_array_equal(edges[edge_offsets[s]:edge_offsets[s + 1]],
+                                  old_loop_edges(nodes[seq], dists[seq], find_edges, 30))
+
+
+def test_batch_matches_old_loop(graph, activities):
+  batch = [[]] + activities[:2] + [activities[0][:1], []] + activities[2:]
+  matched = matching.match_activities_batch(batch, graph, spacing=15.0, max_node_dist=30)
+  assert len(matched) == len(batch)
+  for a, edges in zip(batch, matched):
+    query_xy, _ = matching.resample_activities([a], graph, 15.0)
+    expected = np.empty(0, dtype=np.int64)
+    if len(query_xy):
+      dists, idxs = graph.kdtree.query(query_xy, k=3)
+      expected = old_loop_edges(idxs, dists, graph.find_edges, 30)
+    np.testing.assert_array_equal(edges, expected)
+  assert sum(len(edges) for edges in matched) > 0
+
+
+@pytest.mark.parametrize('method', sorted(matching.MATCHERS))
+def test_tiled_matches_whole_graph(graph, activities, method):
+  tiled = matching.load_tiled_graph(graph_data_folder('CAMBRIDGE_MA_US.gpkg'))
+  batch = activities + [[]]
+  for whole, from_tiles in zip(matching.MATCHERS[method](batch, graph),
+                               matching.match_activities_tiled(batch, tiled, method=method)):
+    np.testing.assert_array_equal(np.sort(from_tiles), np.sort(whole))